@@ -1,40 +1,57 @@
 from __future__ import annotations
 
-import json
+import functools
+import math
+import os
+import tempfile
+import uuid
+from collections import deque
 from datetime import date, timedelta
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Callable, Mapping, Optional
 
-import requests
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 
 import config
+from catalog import CatalogFetcher, PresetCatalog
 from calculator import (
-    biggest_waste,
+    Portfolio,
     cost_per_use,
     euro,
+    euro_cents,
     level_from_xp,
     monthly_cost,
-    total_monthly,
-    xp_for_action,
 )
-from export_image import build_social_card
+from storage import MemoryStorage, SQLiteStorage, Storage, SupabaseStorage
+from subs_cache import DeltaSync
 from supabase_client import (
-    delete_subscription,
-    fetch_challenge,
-    fetch_profile,
+    TOMBSTONE_RETENTION_DAYS,
+    fetch_subscription_changes,
     fetch_subscriptions,
     sign_in,
     sign_out,
     sign_up,
     supabase_enabled,
-    upsert_challenge,
-    upsert_profile,
-    upsert_subscription,
 )
+from tracing import Trace, activate, export_jsonl, span
+
+if TYPE_CHECKING:
+    from export_image import PosterCache
+
+LOGO_PATH = "Budget Tech ITA.png"
+PAGE_SIZES = [10, 25, 50]
+
+
+@st.cache_resource
+def logo_bytes() -> bytes:
+    # Letto da disco una volta per processo, poi servito dalla memoria.
+    with open(LOGO_PATH, "rb") as f:
+        return f.read()
+
 
 st.set_page_config(
     page_title=config.APP_NAME,
-    page_icon="Budget Tech ITA.png",
+    page_icon=logo_bytes(),
     layout="centered",
     initial_sidebar_state="collapsed",
 )
@@ -64,7 +81,6 @@ div[data-testid="stToolbar"] { visibility: hidden; height: 0px; }
 .ss-bad { background: rgba(239,68,68,.12); border: 1px solid rgba(239,68,68,.25); color: #FCA5A5; }
 </style>
 """
-st.markdown(MOBILE_CSS, unsafe_allow_html=True)
 
 HEADER_CSS = """
 <style>
@@ -96,7 +112,8 @@ HEADER_CSS = """
 }
 </style>
 """
-st.markdown(HEADER_CSS, unsafe_allow_html=True)
+# Un solo blocco <style>: va reinviato a ogni rerun, ma come un unico elemento.
+st.markdown(MOBILE_CSS + HEADER_CSS, unsafe_allow_html=True)
 
 
 def ss_init():
@@ -106,109 +123,261 @@ def ss_init():
 
     st.session_state.setdefault("is_premium", True)
 
-    st.session_state.setdefault("subs_local", [])
-    st.session_state.setdefault("profile_local", {"budget_mese": 0.0, "xp": 0})
-    st.session_state.setdefault(
-        "challenge_local",
-        {
-            "active": False,
-            "challenge_id": None,
-            "title": "",
-            "days": 0,
-            "started_at": None,
-            "last_checkin": None,
-            "streak_days": 0,
-        },
-    )
-
 
 ss_init()
 
 
-@st.cache_data(ttl=3600)
-def load_presets() -> dict[str, Any]:
-    url = st.secrets.get("PRESET_JSON_URL")
-    if url:
+def trace_enabled() -> bool:
+    return bool(st.secrets.get("DEBUG_TRACE"))
+
+
+# Tempi del rerun (opt-in: DEBUG_TRACE nei secrets). Spenta, TRACE è None e gli
+# span non registrano niente. Con TRACE_FILE ogni rerun va anche in JSON lines.
+TRACE: Optional[Trace] = None
+if trace_enabled():
+    TRACE = Trace("rerun", session=st.session_state.setdefault("trace_session", uuid.uuid4().hex[:8]))
+activate(TRACE)
+
+
+def finish_trace(trace: Trace) -> None:
+    trace.close()
+    st.session_state.setdefault("traces", deque(maxlen=20)).append(trace)
+    path = st.secrets.get("TRACE_FILE")
+    if path:
         try:
-            r = requests.get(url, timeout=6)
-            r.raise_for_status()
-            return r.json()
-        except Exception:
+            export_jsonl(trace, path)
+        except OSError:
             pass
 
-    try:
-        with open("abbonamenti_predefiniti.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {"items": []}
+
+def tab_trace(name: str) -> Callable[[Callable[[], None]], Callable[[], None]]:
+    # Span del corpo di un tab. Se il fragment gira da solo la traccia del run
+    # completo è già chiusa: il rerun del fragment ne ha una sua.
+    def deco(fn: Callable[[], None]) -> Callable[[], None]:
+        @functools.wraps(fn)
+        def wrapper() -> None:
+            if TRACE is None:
+                return fn()
+            if not TRACE.closed:
+                with span(f"tab.{name}", "tab"):
+                    return fn()
+            trace = Trace(f"fragment.{name}", session=TRACE.session)
+            activate(trace)
+            try:
+                with span(f"tab.{name}", "tab"):
+                    return fn()
+            finally:
+                finish_trace(trace)
+                activate(None)
+
+        return wrapper
+
+    return deco
+
+
+@st.cache_resource
+def preset_fetcher() -> CatalogFetcher:
+    # Un fetcher per processo: serve subito l'ultima copia buona e rivalida il JSON
+    # remoto in background, senza bloccare il primo run.
+    return CatalogFetcher(
+        url=st.secrets.get("PRESET_JSON_URL"),
+        cache_dir=st.secrets.get("PRESET_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "streamsaver"),
+    )
 
 
-PRESETS = load_presets()
-PRESET_ITEMS: list[dict[str, Any]] = PRESETS.get("items", [])
+def preset_catalog() -> PresetCatalog:
+    with span("catalog.load", "catalog"):
+        return preset_fetcher().current()
+
+
+CATALOG = preset_catalog()
 
 
 def preset_names() -> list[str]:
-    return sorted({i.get("nome", "") for i in PRESET_ITEMS if i.get("nome")})
+    return list(CATALOG.names)
+
+
+def preset_by_name(name: str) -> Optional[Mapping[str, Any]]:
+    return CATALOG.by_name(name)
+
 
+@st.cache_resource
+def poster_cache() -> PosterCache:
+    from export_image import PosterCache
 
-def preset_by_name(name: str) -> Optional[dict[str, Any]]:
-    for it in PRESET_ITEMS:
-        if it.get("nome") == name:
-            return it
-    return None
+    # Condivisa tra sessioni: il poster dipende solo dal payload, non dall'utente.
+    return PosterCache(disk_dir=st.secrets.get("POSTER_CACHE_DIR") or None)
 
 
 def is_authed() -> bool:
     return bool(st.session_state.mode == "authed" and st.session_state.user and st.session_state.access_token)
 
 
-def get_subs() -> list[dict]:
+# Snapshot dei dati utente valido per un solo rerun: lo script viene rieseguito
+# da capo a ogni interazione, quindi questo dict riparte sempre vuoto. I rerun dei
+# fragment lo riusano: ogni scrittura invalida la chiave che ha toccato.
+_RUN_SNAPSHOT: dict[str, Any] = {}
+
+
+def invalidate_snapshot(*keys: str) -> None:
+    if not keys:
+        _RUN_SNAPSHOT.clear()
+        return
+    for k in keys:
+        _RUN_SNAPSHOT.pop(k, None)
+        if k == "subs":
+            for derived in ("portfolio", "summary"):
+                _RUN_SNAPSHOT.pop(derived, None)
+
+
+def sub_key(sub: dict, idx: int) -> str:
+    # Chiave stabile per i widget: non cambia se un abbonamento sopra viene eliminato.
+    return str(sub.get("id") or f"idx-{idx}")
+
+
+@st.cache_resource
+def subs_sync() -> DeltaSync:
+    # Copie per utente condivise dal processo: chi torna scarica solo il delta.
+    return DeltaSync(fetch_subscriptions, fetch_subscription_changes, retention_days=TOMBSTONE_RETENTION_DAYS)
+
+
+@st.cache_resource
+def sqlite_storage(path: str) -> SQLiteStorage:
+    return SQLiteStorage(path)
+
+
+# Utente dei backend locali (guest / self-hosted): uno solo per sessione o per file.
+LOCAL_USER = "local"
+
+
+def user_id() -> str:
+    return st.session_state.user["id"] if is_authed() else LOCAL_USER
+
+
+def storage() -> Storage:
+    # Unico accesso ai dati per la UI. Login: Supabase (con cache di sessione).
+    # Senza login: SQLite su file se STORAGE_BACKEND = "sqlite" nei secrets
+    # (self-hosting mono utente, dati condivisi dal processo), altrimenti in
+    # memoria per sessione. Lo store guest ha una chiave sua: login e logout non
+    # lo toccano.
     if is_authed():
-        return fetch_subscriptions(st.session_state.access_token, st.session_state.user["id"])
-    return st.session_state.subs_local
+        store = st.session_state.get("cloud_storage")
+        if store is None or store.access_token != st.session_state.access_token:
+            store = SupabaseStorage(st.session_state.access_token, subs_sync(), page_size=PAGE_SIZES[0])
+            st.session_state.cloud_storage = store
+        return store
+    if st.secrets.get("STORAGE_BACKEND") == "sqlite":
+        return sqlite_storage(st.secrets.get("SQLITE_PATH") or "streamsaver.db")
+    if "guest_storage" not in st.session_state:
+        st.session_state.guest_storage = MemoryStorage()
+    return st.session_state.guest_storage
+
+
+def get_subs() -> list[dict]:
+    if "subs" not in _RUN_SNAPSHOT:
+        _RUN_SNAPSHOT["subs"] = storage().list_subscriptions(user_id())
+    return _RUN_SNAPSHOT["subs"]
+
+
+def save_subscription(row: dict) -> None:
+    try:
+        storage().upsert_subscription(user_id(), row)
+    finally:
+        invalidate_snapshot("subs")
+
+
+def save_subscriptions(rows: list[dict]) -> dict[str, list]:
+    try:
+        return storage().upsert_subscriptions(user_id(), rows)
+    finally:
+        invalidate_snapshot("subs")
+
+
+def remove_subscription(sub_id: str) -> None:
+    try:
+        storage().delete_subscription(user_id(), sub_id)
+    finally:
+        invalidate_snapshot("subs")
+
+
+def get_portfolio() -> Portfolio:
+    if "portfolio" not in _RUN_SNAPSHOT:
+        subs = get_subs()
+        with span("calc.portfolio", "calc", n=len(subs)):
+            _RUN_SNAPSHOT["portfolio"] = Portfolio(subs)
+    return _RUN_SNAPSHOT["portfolio"]
+
+
+def subs_ready() -> bool:
+    # True se la lista completa è già in memoria (get_subs non aspetta la rete).
+    return "subs" in _RUN_SNAPSHOT or storage().subscriptions_ready(user_id())
+
+
+def get_summary() -> dict[str, Any]:
+    if subs_ready():
+        return get_portfolio().summary()
+    if "summary" not in _RUN_SNAPSHOT:
+        _RUN_SNAPSHOT["summary"] = storage().summary(user_id())
+    return _RUN_SNAPSHOT["summary"]
 
 
-def set_subs_local(subs: list[dict]) -> None:
-    st.session_state.subs_local = subs
+def list_page(offset: int, limit: int) -> list[dict]:
+    if "subs" in _RUN_SNAPSHOT:
+        return get_subs()[offset:offset + limit]
+    return storage().page_subscriptions(user_id(), offset, limit)
 
 
 def get_profile() -> dict:
-    if is_authed():
-        prof = fetch_profile(st.session_state.access_token, st.session_state.user["id"])
-        if not prof:
-            prof = {"user_id": st.session_state.user["id"], "budget_mese": 0, "xp": 0}
-            upsert_profile(st.session_state.access_token, prof)
-        return prof
-    return st.session_state.profile_local
+    if "profile" not in _RUN_SNAPSHOT:
+        _RUN_SNAPSHOT["profile"] = storage().get_profile(user_id())
+    return _RUN_SNAPSHOT["profile"]
 
 
 def save_profile(profile: dict) -> None:
-    if is_authed():
-        profile["user_id"] = st.session_state.user["id"]
-        upsert_profile(st.session_state.access_token, profile)
-    else:
-        st.session_state.profile_local = profile
+    # Gli XP non passano da qui: li incrementa solo award_xp (vedi flush_xp).
+    saved = storage().save_profile(user_id(), profile)
+    invalidate_snapshot("profile")
+    if saved:
+        _RUN_SNAPSHOT["profile"] = saved
 
 
 def get_challenge() -> dict:
-    if is_authed():
-        ch = fetch_challenge(st.session_state.access_token, st.session_state.user["id"])
-        return ch or {}
-    return st.session_state.challenge_local
+    if "challenge" not in _RUN_SNAPSHOT:
+        _RUN_SNAPSHOT["challenge"] = storage().get_challenge(user_id())
+    return _RUN_SNAPSHOT["challenge"]
 
 
 def save_challenge(ch: dict) -> None:
-    if is_authed():
-        ch["user_id"] = st.session_state.user["id"]
-        upsert_challenge(st.session_state.access_token, ch)
-    else:
-        st.session_state.challenge_local = ch
+    storage().save_challenge(user_id(), ch)
+    invalidate_snapshot("challenge")
+
+
+def prefetch_user_data() -> None:
+    # Le parti che mancano allo snapshot; i backend remoti le caricano in
+    # parallelo, quelle fallite o scadute le ricaricano i get_* al primo uso.
+    parts = [p for p in ("profile", "challenge") if p not in _RUN_SNAPSHOT]
+    _RUN_SNAPSHOT.update(storage().prefetch(user_id(), parts))
 
 
-def award_xp(profile: dict, action: str) -> dict:
-    profile = dict(profile or {})
-    profile["xp"] = int(profile.get("xp") or 0) + xp_for_action(action)
-    return profile
+def queue_xp(action: str) -> None:
+    st.session_state.setdefault("xp_pending", []).append(action)
+
+
+def flush_xp() -> Optional[dict[str, int]]:
+    actions = list(st.session_state.get("xp_pending") or [])
+    if not actions:
+        return None
+    try:
+        res = storage().award_xp(user_id(), actions)
+    except Exception:
+        # Incremento fallito (rete, RPC): le azioni restano in coda e ripartono
+        # al prossimo flush, niente XP persi.
+        return None
+    del st.session_state.xp_pending[:len(actions)]
+    prof = _RUN_SNAPSHOT.get("profile")
+    if res and prof is not None:
+        prof["xp"] = res["xp"]
+    return res
 
 
 def check_premium_key(k: str) -> bool:
@@ -225,7 +394,7 @@ def free_limit() -> int:
 col_logo, col_text = st.columns([1, 5])
 
 with col_logo:
-    st.image("Budget Tech ITA.png", width=85)
+    st.image(logo_bytes(), width=85)
 
 with col_text:
     st.markdown("""
@@ -249,9 +418,12 @@ with st.expander("🔐 Login & Cloud Save (Supabase)", expanded=False):
                     sign_out(st.session_state.access_token)
                 except Exception:
                     pass
+                # Niente copie dei dati dell'utente in memoria dopo il logout.
+                subs_sync().forget(user_id())
                 st.session_state.mode = "guest"
                 st.session_state.user = None
                 st.session_state.access_token = None
+                st.session_state.pop("cloud_storage", None)
                 st.rerun()
         else:
             col1, col2 = st.columns(2)
@@ -309,26 +481,23 @@ with col_kofi_2:
     )
 
 
-subs = get_subs()
-profile = get_profile()
-challenge = get_challenge()
-
-monthly = total_monthly(subs)
-budget = float(profile.get("budget_mese") or 0.0)
-remaining = float(budget) - float(monthly) if budget else None
-
-xp = int(profile.get("xp") or 0)
-lvl, to_next = level_from_xp(xp)
-
 is_premium = bool(st.session_state.is_premium)
 limit_reached = False
 
-tab_subs, tab_chal, tab_templates, tab_export = st.tabs(
-    ["📋 Abbonamenti", "🏁 Challenge", "⚡ Setup", "📸 Export Poster"]
-)
 
-with tab_subs:
-    st.markdown(
+# Ogni tab è un fragment: un click riesegue solo il suo pannello, non la pagina
+# intera (niente fetch degli altri tab, niente render del poster). I totali in
+# cima stanno in segnaposto creati dal run completo, che i fragment riscrivono.
+def render_totals() -> None:
+    summary = get_summary()
+    profile = get_profile()
+    monthly = summary["monthly_total"]
+    budget = float(profile.get("budget_mese") or 0.0)
+    remaining = float(budget) - float(monthly) if budget else None
+    xp = int(profile.get("xp") or 0)
+    lvl, to_next = level_from_xp(xp)
+
+    TOTALS_SLOT.markdown(
         f"""
 <div class="ss-card">
   <div class="ss-row">
@@ -348,22 +517,76 @@ with tab_subs:
         unsafe_allow_html=True,
     )
 
+    if budget and remaining is not None:
+        with BUDGET_SLOT.container():
+            ratio = min(max(float(monthly) / float(budget), 0.0), 1.0) if budget > 0 else 0.0
+            st.progress(ratio)
+            pill_class = "ss-pill" if remaining >= 0 else "ss-pill ss-bad"
+            st.markdown(f"<span class='{pill_class}'>Rimanente: {euro(remaining)}</span>", unsafe_allow_html=True)
+    else:
+        BUDGET_SLOT.empty()
+
+
+# Pannelli che mostrano dati scritti anche da altri tab (lista, budget, challenge).
+STALE_VIEWS = ("challenge", "export")
+
+
+def rerun_panel() -> None:
+    # Dopo una scrittura: riesegue solo il fragment corrente, che al suo avvio
+    # aggiorna i totali condivisi. Gli altri tab restano come erano stati
+    # disegnati: vengono segnati da aggiornare e si ridisegnano al loro prossimo
+    # run (vedi refresh_bar). Se il click è arrivato durante un run completo
+    # (es. AppTest) lo scope "fragment" non è ammesso e si riesegue la pagina.
+    flush_xp()
+    st.session_state.totals_dirty = True
+    st.session_state.stale_views = set(STALE_VIEWS)
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+def refresh_bar(view: str) -> bool:
+    # I tab cambiano lato client, senza rerun: un pannello disegnato prima di una
+    # scrittura in un altro tab resta com'era finché non riparte. Il pulsante lo fa
+    # ripartire da solo. True se i dati sono cambiati dall'ultimo run del pannello.
+    stale = st.session_state.setdefault("stale_views", set(STALE_VIEWS))
+    changed = view in stale
+    stale.discard(view)
+    st.button("🔄 Aggiorna", key=f"refresh_{view}", help="Mostra le modifiche fatte negli altri tab")
+    return changed
+
+
+def sync_totals() -> None:
+    if st.session_state.pop("totals_dirty", False):
+        render_totals()
+
+
+@st.fragment
+@tab_trace("budget")
+def budget_goal() -> None:
+    sync_totals()
+    profile = get_profile()
     st.markdown("### 🎯 Budget Goal")
-    new_budget = st.number_input("Budget mensile (€)", min_value=0.0, value=float(budget), step=5.0)
+    new_budget = st.number_input("Budget mensile (€)", min_value=0.0, value=float(profile.get("budget_mese") or 0.0), step=5.0)
     if st.button("Salva budget", use_container_width=True):
         profile["budget_mese"] = float(new_budget)
-        profile = award_xp(profile, "set_budget")
         save_profile(profile)
+        queue_xp("set_budget")
         st.success("Budget salvato ✅")
-        st.rerun()
+        rerun_panel()
 
-    if budget and remaining is not None:
-        ratio = min(max(float(monthly) / float(budget), 0.0), 1.0) if budget > 0 else 0.0
-        st.progress(ratio)
-        pill_class = "ss-pill" if remaining >= 0 else "ss-pill ss-bad"
-        st.markdown(f"<span class='{pill_class}'>Rimanente: {euro(remaining)}</span>", unsafe_allow_html=True)
 
-    st.divider()
+def toggle_edit(sid: str) -> None:
+    st.session_state.editing_sub = None if st.session_state.get("editing_sub") == sid else sid
+
+
+@st.fragment
+@tab_trace("subs")
+def subscriptions_panel() -> None:
+    sync_totals()
+    summary = get_summary()
+    n_subs = summary["count"]
 
     st.markdown("### ➕ Aggiungi abbonamento")
     mode = st.radio("Scegli tipo", ["Predefinito", "Custom"], horizontal=True, disabled=limit_reached)
@@ -436,26 +659,19 @@ with tab_subs:
                 "custom": mode == "Custom",
             }
 
-            if is_authed():
-                row["user_id"] = st.session_state.user["id"]
-                upsert_subscription(st.session_state.access_token, row)
-            else:
-                local = list(st.session_state.subs_local)
-                local.insert(0, row)
-                set_subs_local(local)
+            save_subscription(row)
 
-            profile = award_xp(profile, "add_subscription")
-            save_profile(profile)
+            queue_xp("add_subscription")
             st.success("Aggiunto ✅")
-            st.rerun()
+            rerun_panel()
 
     st.divider()
 
     st.markdown("### 📋 I tuoi abbonamenti")
-    if not subs:
+    if not n_subs:
         st.info("Nessun abbonamento ancora. Aggiungine uno per vedere il costo/uso.")
     else:
-        waste = biggest_waste(subs)
+        waste = summary["worst"]
         if waste:
             w_cpu = cost_per_use(waste)
             badge = "ss-pill ss-bad" if (w_cpu is not None and float(w_cpu) >= 2.0) else "ss-pill ss-warn"
@@ -475,14 +691,34 @@ with tab_subs:
                 unsafe_allow_html=True,
             )
 
-        for idx, s in enumerate(subs):
+        n_pages = max(1, math.ceil(n_subs / PAGE_SIZES[0]))
+        page_size = PAGE_SIZES[0]
+        page = 1
+        if n_subs > PAGE_SIZES[0]:
+            pc1, pc2 = st.columns(2)
+            with pc1:
+                page_size = st.selectbox("Abbonamenti per pagina", PAGE_SIZES, key="subs_page_size")
+            n_pages = max(1, math.ceil(n_subs / page_size))
+            if st.session_state.get("subs_page", 1) > n_pages:
+                st.session_state.subs_page = n_pages
+            with pc2:
+                page = int(st.number_input(f"Pagina (di {n_pages})", min_value=1, max_value=n_pages, step=1, key="subs_page"))
+
+        # Solo la pagina corrente, e i widget di modifica solo per la card aperta:
+        # il costo del rerun non cresce con il numero di abbonamenti.
+        start = (page - 1) * page_size
+        rows = list_page(start, page_size)
+        page_pf = Portfolio(rows)
+        for j, s in enumerate(rows):
+            idx = start + j
+            sid = sub_key(s, idx)
             name = s.get("nome", "")
             icon = s.get("icona", "💳")
             cat = s.get("categoria", "Altro")
-            mc = monthly_cost(s)
-            cpu = cost_per_use(s)
-            cpu_txt = euro(cpu) if cpu is not None else "n/a"
-            pill = "ss-pill" if cpu is not None and float(cpu) < 1.0 else "ss-pill ss-warn" if cpu is not None else "ss-pill ss-bad"
+            mc = page_pf.monthly_c[j]
+            cpu = page_pf.cpu_c[j]
+            cpu_txt = euro_cents(cpu) if cpu is not None else "n/a"
+            pill = "ss-pill" if cpu is not None and cpu[0] < 100 * cpu[1] else "ss-pill ss-warn" if cpu is not None else "ss-pill ss-bad"
 
             st.markdown(
                 f"""
@@ -490,7 +726,7 @@ with tab_subs:
   <div class="ss-row">
     <div>
       <div class="ss-big">{icon} {name}</div>
-      <div class="ss-muted">{cat} • {euro(mc)}/mese</div>
+      <div class="ss-muted">{cat} • {euro_cents(mc)}/mese</div>
       <div class="ss-muted">🔥 Costo/uso: <span class="{pill}">{cpu_txt}</span></div>
     </div>
   </div>
@@ -499,6 +735,18 @@ with tab_subs:
                 unsafe_allow_html=True,
             )
 
+            # Il callback gira prima del rerun: etichetta e editor leggono lo stesso stato.
+            editing = st.session_state.get("editing_sub") == sid
+            st.button(
+                "✖️ Chiudi" if editing else "✏️ Modifica",
+                key=f"edit_{sid}",
+                on_click=toggle_edit,
+                args=(sid,),
+                use_container_width=True,
+            )
+            if not editing:
+                continue
+
             c1, c2, c3 = st.columns([1.2, 1.2, 1.0])
             with c1:
                 new_uses = st.number_input(
@@ -506,7 +754,7 @@ with tab_subs:
                     min_value=0,
                     value=int(s.get("utilizzi_mese") or 0),
                     step=1,
-                    key=f"uses_{idx}",
+                    key=f"uses_{sid}",
                 )
             with c2:
                 new_price = st.number_input(
@@ -514,42 +762,32 @@ with tab_subs:
                     min_value=0.0,
                     value=float(s.get("prezzo_mese") or 0.0),
                     step=1.0,
-                    key=f"price_{idx}",
+                    key=f"price_{sid}",
                 )
             with c3:
-                if st.button("🗑️ Elimina", key=f"del_{idx}", use_container_width=True):
-                    if is_authed() and s.get("id"):
-                        delete_subscription(st.session_state.access_token, s["id"], st.session_state.user["id"])
-                    else:
-                        local = list(st.session_state.subs_local)
-                        if 0 <= idx < len(local):
-                            local.pop(idx)
-                        set_subs_local(local)
-
-                    profile = award_xp(profile, "delete_subscription")
-                    save_profile(profile)
-                    st.rerun()
+                if st.button("🗑️ Elimina", key=f"del_{sid}", use_container_width=True):
+                    remove_subscription(s["id"])
+                    st.session_state.editing_sub = None
+                    queue_xp("delete_subscription")
+                    rerun_panel()
 
-            if st.button("Salva modifiche", key=f"save_{idx}", use_container_width=True):
+            if st.button("Salva modifiche", key=f"save_{sid}", use_container_width=True):
                 s2 = dict(s)
                 s2["utilizzi_mese"] = int(new_uses)
                 s2["prezzo_mese"] = float(new_price)
-                if is_authed():
-                    s2["user_id"] = st.session_state.user["id"]
-                    upsert_subscription(st.session_state.access_token, s2)
-                else:
-                    local = list(st.session_state.subs_local)
-                    if 0 <= idx < len(local):
-                        local[idx] = s2
-                    set_subs_local(local)
+                save_subscription(s2)
                 st.success("Salvato ✅")
-                st.rerun()
+                rerun_panel()
 
 
-with tab_chal:
+@st.fragment
+@tab_trace("challenge")
+def challenge_panel() -> None:
+    sync_totals()
     st.markdown("### 🏁 Challenge Risparmio")
+    refresh_bar("challenge")
 
-    ch = challenge or {}
+    ch = dict(get_challenge() or {})
     active = bool(ch.get("active"))
 
     if active:
@@ -603,10 +841,9 @@ with tab_chal:
                     ch["last_checkin"] = today.isoformat()
                     save_challenge(ch)
 
-                    profile = award_xp(profile, "checkin")
-                    save_profile(profile)
+                    queue_xp("checkin")
                     st.success("Check-in fatto ✅")
-                    st.rerun()
+                    rerun_panel()
 
         with c2:
             if st.button("🛑 Termina challenge", use_container_width=True):
@@ -621,27 +858,30 @@ with tab_chal:
                 }
                 save_challenge(ch)
                 st.success("Challenge terminata.")
-                st.rerun()
+                rerun_panel()
 
         st.divider()
 
         st.markdown("### 🧨 Suggerimento rapido: cosa tagliare")
-        subs_now = get_subs()
-        w = biggest_waste(subs_now)
-        if not w:
+        cuts = get_portfolio().cut_list(5)
+        if not cuts:
             st.info("Aggiungi almeno 1 abbonamento per avere suggerimenti.")
         else:
-            w_cpu = cost_per_use(w)
-            st.markdown(
-                f"""
+            for n, cut in enumerate(cuts, start=1):
+                w = cut["sub"]
+                w_cpu = cut["cpu"]
+                st.markdown(
+                    f"""
 <div class="ss-card">
-  <div class="ss-muted">Candidato #1</div>
+  <div class="ss-muted">Candidato #{n}</div>
   <div class="ss-big">{w.get("icona","💳")} {w.get("nome","")}</div>
-  <div class="ss-muted">Costo/uso: {euro(w_cpu) if w_cpu else "n/a"} • Risparmio stimato: {euro(monthly_cost(w))}/mese</div>
+  <div class="ss-muted">Costo/uso: {euro_cents(w_cpu) if w_cpu and w_cpu[0] else "n/a"} • Risparmio stimato: {euro_cents(cut["monthly"])}/mese</div>
 </div>
 """,
-                unsafe_allow_html=True,
-            )
+                    unsafe_allow_html=True,
+                )
+            if len(cuts) > 1:
+                st.caption(f"Tagliando tutti i {len(cuts)} candidati risparmi {euro_cents(cuts[-1]['saving_cumulative'])}/mese.")
 
     else:
         st.info("Nessuna challenge attiva. Avviane una per lo streak e la gamification.")
@@ -663,13 +903,14 @@ with tab_chal:
                 "streak_days": 0,
             }
             save_challenge(ch)
-            profile = award_xp(profile, "start_challenge")
-            save_profile(profile)
+            queue_xp("start_challenge")
             st.success("Challenge avviata ✅")
-            st.rerun()
+            rerun_panel()
 
 
-with tab_templates:
+@st.fragment
+@tab_trace("templates")
+def templates_panel() -> None:
     st.markdown("### ⚡ Setup (Content Ready)")
 
     tpl_titles = [t["title"] for t in config.TEMPLATES]
@@ -697,18 +938,19 @@ with tab_templates:
         remaining_slots = 10**9 if is_premium else max(0, free_limit() - len(subs_now))
         to_add = tpl.get("items", [])[:remaining_slots]
 
-        added = 0
+        rows = []
         for item in to_add:
             name = item.get("nome")
             uses = int(item.get("utilizzi_mese") or 0)
-            p = preset_by_name(name) or {
+            found = preset_by_name(name)
+            p = found or {
                 "nome": name,
                 "categoria": "Altro",
                 "icona": "💳",
                 "prezzo_mese": 0.0,
                 "prezzo_anno_originale": None,
             }
-            row = {
+            rows.append({
                 "nome": p.get("nome"),
                 "categoria": p.get("categoria", "Altro"),
                 "icona": p.get("icona", "💳"),
@@ -717,84 +959,107 @@ with tab_templates:
                 "prezzo_anno_originale": p.get("prezzo_anno_originale"),
                 "utilizzi_mese": uses,
                 "data_rinnovo": None,
-                "custom": False if preset_by_name(name) else True,
-            }
+                "custom": found is None,
+            })
 
-            if is_authed():
-                row["user_id"] = st.session_state.user["id"]
-                upsert_subscription(st.session_state.access_token, row)
-            else:
-                local = list(st.session_state.subs_local)
-                local.insert(0, row)
-                set_subs_local(local)
+        res = save_subscriptions(rows)
+        added = len(res["saved"])
+        failed = res["failed"]
 
-            added += 1
-
-        profile = award_xp(profile, "import_template")
-        save_profile(profile)
+        queue_xp("import_template")
+        flush_xp()
         st.success(f"Import completato ✅ (+{added} abbonamenti)")
-        st.rerun()
+        if failed:
+            n_failed = sum(len(f["rows"]) for f in failed)
+            st.warning(f"{n_failed} abbonamenti non importati: {failed[0]['error']}")
+        else:
+            # L'import cambia lista, challenge e poster insieme: qui serve la pagina intera.
+            st.rerun()
 
     st.caption("Tip virale: registra schermo mentre sistemi “costo/uso” e fai il reveal dello spreco.")
 
 
-with tab_export:
-    st.markdown("### 📸 Export Poster (9:16)")
-    subs_now = get_subs()
+def poster_payload() -> Optional[dict[str, Any]]:
+    portfolio = get_portfolio()
+    if not portfolio.subs:
+        return None
+    best, worst = portfolio.best_and_worst_cpu()
+    best_cpu_txt = None
+    worst_cpu_txt = None
+    if best and worst:
+        best_cpu_txt = f"{best[1].get('nome','')} • {euro_cents(best[0])}"
+        worst_cpu_txt = f"{worst[1].get('nome','')} • {euro_cents(worst[0])}"
+
+    ch = get_challenge() or {}
+    challenge_title = ch.get("title") if ch.get("active") else "Nessuna challenge attiva"
+    streak = int(ch.get("streak_days") or 0) if ch.get("active") else 0
+
+    monthly = float(portfolio.total_monthly)
+    budget = float(get_profile().get("budget_mese") or 0.0)
+    return {
+        "title": "StreamSaver",
+        "subtitle": "Quanto ti costa OGNI utilizzo?",
+        "monthly_total": monthly,
+        "budget": budget,
+        "remaining": budget - monthly if budget else None,
+        "best_cpu": best_cpu_txt,
+        "worst_cpu": worst_cpu_txt,
+        "challenge_title": challenge_title,
+        "streak_days": streak,
+        "footer": "Condividi questo poster sui social: #BudgetTech #Risparmio",
+    }
+
 
-    if not subs_now:
+@st.fragment
+@tab_trace("export")
+def export_panel() -> None:
+    sync_totals()
+    st.markdown("### 📸 Export Poster (9:16)")
+    # Il payload si ricalcola solo se i dati sono cambiati: cambio tema e XP
+    # dell'export rieseguono il fragment senza toccare lista e challenge.
+    if refresh_bar("export") or "poster_payload" not in st.session_state:
+        st.session_state.poster_payload = poster_payload()
+    payload = st.session_state.poster_payload
+    if payload is None:
         st.info("Aggiungi almeno 1 abbonamento per generare il poster.")
     else:
-        cpus = []
-        for s in subs_now:
-            c = cost_per_use(s)
-            if c is not None:
-                cpus.append((float(c), s))
-        best_cpu_txt = None
-        worst_cpu_txt = None
-        if cpus:
-            cpus.sort(key=lambda x: x[0])
-            best = cpus[0]
-            worst = cpus[-1]
-            best_cpu_txt = f"{best[1].get('nome','')} • {euro(best[0])}"
-            worst_cpu_txt = f"{worst[1].get('nome','')} • {euro(worst[0])}"
-
-        ch = get_challenge() or {}
-        challenge_title = ch.get("title") if ch.get("active") else "Nessuna challenge attiva"
-        streak = int(ch.get("streak_days") or 0) if ch.get("active") else 0
-
-        payload = {
-            "title": "StreamSaver",
-            "subtitle": "Quanto ti costa OGNI utilizzo?",
-            "monthly_total": float(total_monthly(subs_now)),
-            "budget": float(get_profile().get("budget_mese") or 0.0),
-            "remaining": float(remaining) if remaining is not None else None,
-            "best_cpu": best_cpu_txt,
-            "worst_cpu": worst_cpu_txt,
-            "challenge_title": challenge_title,
-            "streak_days": streak,
-            "footer": "Condividi questo poster sui social: #BudgetTech #Risparmio",
-        }
+        # Import lazy: PIL serve solo a chi genera il poster.
+        from export_image import (
+            DOWNLOAD_ENCODING,
+            PREVIEW_ENCODING,
+            THEMES,
+            cached_social_card,
+            encoding_mime,
+        )
 
-        img_bytes = build_social_card(payload, size=config.EXPORT_SIZE)
+        theme = st.radio("Tema poster", list(THEMES), horizontal=True, format_func=str.capitalize)
+        poster_args = {
+            "size": config.EXPORT_SIZE,
+            "stamp": date.today().strftime("%d/%m/%Y"),
+            "cache": poster_cache(),
+            "theme": theme,
+        }
+        with span("poster.cached_social_card", "poster"):
+            preview_bytes = cached_social_card(payload, encoding=PREVIEW_ENCODING, **poster_args)
+            download_bytes = cached_social_card(payload, encoding=DOWNLOAD_ENCODING, **poster_args)
+        download_mime, download_ext = encoding_mime(DOWNLOAD_ENCODING)
 
-        st.image(img_bytes, caption="Anteprima poster (1080×1920)", use_container_width=True)
+        st.image(preview_bytes, caption="Anteprima poster (1080×1920)", use_container_width=True)
 
         c1, c2 = st.columns(2)
         with c1:
             st.download_button(
-                "⬇️ Scarica PNG",
-                data=img_bytes,
-                file_name="streamsaver_social_poster.png",
-                mime="image/png",
+                f"⬇️ Scarica {download_ext.upper()}",
+                data=download_bytes,
+                file_name=f"streamsaver_social_poster.{download_ext}",
+                mime=download_mime,
                 use_container_width=True,
             )
         with c2:
             if st.button("✅ Segna Export (XP)", use_container_width=True):
-                profile = award_xp(get_profile(), "export")
-                save_profile(profile)
+                queue_xp("export")
                 st.success("XP aggiunti ✅")
-                st.rerun()
+                rerun_panel()
 
         st.markdown("**Caption pronta (copia/incolla):**")
         caption = (
@@ -806,6 +1071,59 @@ with tab_export:
         st.caption("Tip: usa la preview + hook del template e fai un 'reveal' del peggior costo/uso.")
 
 
+with span("data.prefetch", "data"):
+    prefetch_user_data()
+
+tab_subs, tab_chal, tab_templates, tab_export = st.tabs(
+    ["📋 Abbonamenti", "🏁 Challenge", "⚡ Setup", "📸 Export Poster"]
+)
+
+with tab_subs:
+    st.session_state.pop("totals_dirty", None)
+    # Run completo: tutti i pannelli ripartono dai dati freschi.
+    st.session_state.stale_views = set(STALE_VIEWS)
+    TOTALS_SLOT = st.empty()
+    budget_goal()
+    BUDGET_SLOT = st.empty()
+    with span("ui.totals", "ui"):
+        render_totals()
+    st.divider()
+    subscriptions_panel()
+
+with tab_chal:
+    challenge_panel()
+
+with tab_templates:
+    templates_panel()
+
+with tab_export:
+    export_panel()
+
+
+def debug_panel() -> None:
+    traces = list(st.session_state.get("traces") or [])[::-1]
+    with st.expander("🛠️ Debug: tempi per rerun", expanded=False):
+        pick = st.selectbox(
+            "Rerun",
+            range(len(traces)),
+            format_func=lambda i: f"{traces[i].label} • {traces[i].duration * 1e3:.1f} ms • {len(traces[i].spans)} span",
+            key="trace_pick",
+        )
+        st.dataframe(traces[pick or 0].summary(), hide_index=True, use_container_width=True)
+        st.download_button(
+            "⬇️ Trace (JSON lines)",
+            data="".join(t.jsonl() for t in reversed(traces)),
+            file_name="streamsaver_trace.jsonl",
+            mime="application/x-ndjson",
+            use_container_width=True,
+        )
+
+
+if TRACE is not None:
+    finish_trace(TRACE)
+    debug_panel()
+
+
 st.divider()
 st.markdown(
     """
@@ -0,0 +1,363 @@
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import IO, Any, Callable, Optional
+
+import calculator as calc
+from cents_check import cents_mismatches
+
+# Benchmark di calcoli, poster e catalogo. Risultati in JSON e confronto con una
+# baseline salvata: exit 1 se una misura rallenta oltre la soglia.
+#
+#   python bench.py calc poster catalog --json base.json
+#   python bench.py calc poster catalog --baseline base.json --threshold 0.15
+
+SIZES = [10, 1_000, 10_000, 100_000]
+SUITES = ["calc", "cents", "poster", "encode", "catalog", "startup"]
+CATALOG_PATH = "abbonamenti_predefiniti.json"
+
+
+def synthetic_subs(n: int, seed: int = 42) -> list[dict[str, Any]]:
+    # Abbonamenti finti ma realistici, generati dal catalogo predefinito.
+    with open(CATALOG_PATH, "r", encoding="utf-8") as f:
+        items = json.load(f).get("items", [])
+    rnd = random.Random(seed)
+    subs = []
+    for i in range(n):
+        it = rnd.choice(items)
+        annual = bool(it.get("prezzo_anno_originale")) and rnd.random() < 0.5
+        subs.append({
+            "id": f"sub-{i}",
+            "nome": it.get("nome"),
+            "categoria": it.get("categoria", "Altro"),
+            "icona": it.get("icona", "💳"),
+            "tipo_pagamento": "annuale" if annual else "mensile",
+            "prezzo_mese": it.get("prezzo_mese"),
+            "prezzo_anno_originale": it.get("prezzo_anno_originale"),
+            "utilizzi_mese": rnd.choice([0, 1, 2, 3, 4, 6, 8, 12, 20, 30]),
+        })
+    return subs
+
+
+# Ripetizioni per misura: vale la migliore, meno sensibile al rumore della macchina.
+REPEAT = 3
+
+
+def _timeit(fn: Callable[[], Any], min_time: float = 0.2) -> float:
+    best = float("inf")
+    for _ in range(REPEAT):
+        runs = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            runs += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / runs)
+    return best
+
+
+def bench_calc(sizes: list[int]) -> list[dict[str, Any]]:
+    # Le funzioni usate a ogni rerun, sulla stessa lista: aggregati, ranking e costo/uso per riga.
+    results = []
+    for n in sizes:
+        subs = synthetic_subs(n)
+        results.append({
+            "n": n,
+            "total_monthly_s": _timeit(lambda: calc.total_monthly(subs)),
+            "biggest_waste_s": _timeit(lambda: calc.biggest_waste(subs)),
+            "cost_per_use_s": _timeit(lambda: [calc.cost_per_use(s) for s in subs]),
+            "portfolio_s": _timeit(lambda: calc.Portfolio(subs).summary()),
+        })
+    return results
+
+
+def bench_cents(sizes: list[int]) -> list[dict[str, Any]]:
+    results = []
+    for n in sizes:
+        subs = synthetic_subs(n)
+
+        def legacy():
+            calc.euro(calc.total_monthly(subs))
+            calc.biggest_waste(subs)
+            for s in subs:
+                calc.euro(calc.monthly_cost(s))
+                c = calc.cost_per_use(s)
+                if c is not None:
+                    calc.euro(c)
+
+        def cents():
+            p = calc.Portfolio(subs)
+            calc.euro(p.total_monthly)
+            p.biggest_waste()
+            for m, c in zip(p.monthly_c, p.cpu_c):
+                calc.euro_cents(m)
+                if c is not None:
+                    calc.euro_cents(c)
+
+        t_dec = _timeit(legacy)
+        t_cents = _timeit(cents)
+        results.append({"n": n, "decimal_s": t_dec, "cents_s": t_cents, "speedup": t_dec / t_cents})
+    return results
+
+
+SAMPLE_PAYLOAD = {
+    "title": "StreamSaver",
+    "subtitle": "Quanto ti costa OGNI utilizzo?",
+    "monthly_total": 87.45,
+    "budget": 100.0,
+    "remaining": 12.55,
+    "best_cpu": "Spotify Premium • €0,36",
+    "worst_cpu": "DAZN • €17,50",
+    "challenge_title": "Taglia 1 abbonamento a settimana",
+    "streak_days": 6,
+    "footer": "Condividi questo poster sui social: #BudgetTech #Risparmio",
+}
+
+
+POSTER_SIZES = [(540, 960), (1080, 1920), (1440, 2560)]
+
+POSTER_VARIANTS = {
+    "full": SAMPLE_PAYLOAD,
+    # Solo i default: niente metriche opzionali, footer e titoli predefiniti.
+    "minimal": {"monthly_total": 0, "budget": 0},
+    # Testi lunghi: troncamento e wrap lavorano a ogni riga.
+    "long_text": {
+        **SAMPLE_PAYLOAD,
+        "title": "StreamSaver " * 8,
+        "subtitle": "Quanto ti costa davvero ogni singolo utilizzo di ogni abbonamento? " * 3,
+        "best_cpu": "Abbonamento con un nome davvero lunghissimo " * 3 + "• €0,36",
+        "worst_cpu": "Pacchetto sport premium con tutti i canali " * 3 + "• €17,50",
+        "challenge_title": "Taglia un abbonamento a settimana per un mese intero " * 2,
+        "footer": "Condividi questo poster sui social " * 6,
+    },
+    "over_budget": {**SAMPLE_PAYLOAD, "monthly_total": 1234.56, "remaining": -1134.56, "streak_days": 365},
+}
+
+
+def bench_poster(sizes: list[tuple[int, int]], encoding: str = "png") -> list[dict[str, Any]]:
+    import export_image
+
+    results = []
+    for w, h in sizes:
+        for variant, payload in POSTER_VARIANTS.items():
+            # Primo render fuori misura: layer statico e font sono in cache dopo il primo poster.
+            data = export_image.build_social_card(payload, size=(w, h), stamp="01/01/2026", encoding=encoding)
+            t = _timeit(lambda: export_image.build_social_card(payload, size=(w, h), stamp="01/01/2026", encoding=encoding), min_time=0.5)
+            results.append({"size": f"{w}x{h}", "variant": variant, "encoding": encoding, "build_s": t, "bytes": len(data)})
+    return results
+
+
+def bench_encodings() -> list[dict[str, Any]]:
+    import export_image
+
+    img = export_image.render_social_card(SAMPLE_PAYLOAD, stamp="01/01/2026")
+    results = []
+    for name in export_image.ENCODINGS:
+        data = export_image.encode_image(img, name)
+        t = _timeit(lambda: export_image.encode_image(img, name), min_time=0.5)
+        results.append({"encoding": name, "encode_s": t, "bytes": len(data)})
+    return results
+
+
+def _scaled_catalog(raw: dict[str, Any], factor: int) -> dict[str, Any]:
+    # Catalogo `factor` volte più grande, con nomi unici come uno vero.
+    items = raw.get("items", [])
+    scaled = [dict(it, nome=f"{it.get('nome')} {k}" if k else it.get("nome")) for k in range(factor) for it in items]
+    return {**raw, "items": scaled}
+
+
+def bench_catalog(factors: tuple[int, ...] = (1, 10, 100)) -> list[dict[str, Any]]:
+    from catalog import CatalogFetcher, PresetCatalog
+
+    with open(CATALOG_PATH, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    results = []
+    for factor in factors:
+        text = json.dumps(_scaled_catalog(raw, factor))
+        results.append({
+            "factor": factor,
+            "items": len(raw.get("items", [])) * factor,
+            "parse_s": _timeit(lambda: PresetCatalog(json.loads(text))),
+        })
+    # Primo run di una sessione nuova: lettura del file locale, parse e indici.
+    results[0]["cold_load_s"] = _timeit(lambda: CatalogFetcher(None, local_path=CATALOG_PATH).current())
+    return results
+
+
+STARTUP_MODULES = ["streamlit", "supabase", "PIL.Image", "requests", "calculator", "catalog", "supabase_client", "export_image"]
+
+_FIRST_PAINT = """
+import json, os, sys, time
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(os.path.abspath("app.py"), default_timeout=60)
+at.secrets["BENCH"] = "1"
+t1 = time.perf_counter()
+at.run()
+t2 = time.perf_counter()
+t3 = time.perf_counter()
+at.run()
+t4 = time.perf_counter()
+print(json.dumps({
+    "harness_import_s": t1 - t0,
+    "first_run_s": t2 - t1,
+    "rerun_s": t4 - t3,
+    "errors": len(at.exception),
+    "loaded": {m: m in sys.modules for m in ("supabase", "PIL", "requests")},
+}))
+"""
+
+
+def _run_py(code: str) -> str:
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return out.stdout.strip().splitlines()[-1]
+
+
+def bench_startup() -> dict[str, Any]:
+    # Ogni misura in un processo nuovo: conta l'import a freddo, non quello già in sys.modules.
+    imports = {}
+    for mod in STARTUP_MODULES:
+        code = f"import time; t = time.perf_counter(); import {mod}; print(time.perf_counter() - t)"
+        imports[mod] = float(_run_py(code))
+    return {"imports_s": imports, "first_paint": json.loads(_run_py(_FIRST_PAINT))}
+
+
+def metrics(results: dict[str, Any]) -> dict[str, float]:
+    # Tempi in forma piatta "suite.misura[parametri]": è quello che si confronta con la baseline.
+    out: dict[str, float] = {}
+    for r in results.get("calc", []):
+        for k in ("total_monthly_s", "biggest_waste_s", "cost_per_use_s", "portfolio_s"):
+            out[f"calc.{k[:-2]}[n={r['n']}]"] = r[k]
+    for r in results.get("cents", []):
+        out[f"cents.decimal[n={r['n']}]"] = r["decimal_s"]
+        out[f"cents.cents[n={r['n']}]"] = r["cents_s"]
+    for r in results.get("poster", []):
+        out[f"poster.{r['variant']}[{r['size']},{r['encoding']}]"] = r["build_s"]
+    for r in results.get("encode", []):
+        out[f"encode.{r['encoding']}"] = r["encode_s"]
+    for r in results.get("catalog", []):
+        out[f"catalog.parse[items={r['items']}]"] = r["parse_s"]
+        if "cold_load_s" in r:
+            out[f"catalog.cold_load[items={r['items']}]"] = r["cold_load_s"]
+    startup = results.get("startup")
+    if startup:
+        for mod, t in startup["imports_s"].items():
+            out[f"startup.import[{mod}]"] = t
+        out["startup.first_run"] = startup["first_paint"]["first_run_s"]
+        out["startup.rerun"] = startup["first_paint"]["rerun_s"]
+    return out
+
+
+def compare(current: dict[str, float], baseline: dict[str, float], threshold: float) -> list[dict[str, Any]]:
+    # Regressione: più lento della baseline di oltre `threshold` (0.10 = +10%).
+    # Le misure presenti da una sola parte vengono ignorate.
+    rows = []
+    for name in sorted(current.keys() & baseline.keys()):
+        new, old = current[name], baseline[name]
+        ratio = new / old if old > 0 else 1.0
+        rows.append({"metric": name, "baseline_s": old, "current_s": new, "ratio": ratio, "regression": ratio > 1 + threshold})
+    return rows
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    global REPEAT
+    ap = argparse.ArgumentParser(description="StreamSaver benchmarks")
+    ap.add_argument("suite", nargs="*", choices=["all"] + SUITES, default=["all"])
+    ap.add_argument("--sizes", type=int, nargs="*", default=SIZES)
+    ap.add_argument("--skip-check", action="store_true")
+    ap.add_argument("--repeat", type=int, default=REPEAT, help="ripetizioni per misura (vale la migliore)")
+    ap.add_argument("--json", metavar="PATH", help="scrive i risultati in JSON ('-' per stdout)")
+    ap.add_argument("--baseline", metavar="PATH", help="JSON di un run precedente da confrontare")
+    ap.add_argument("--threshold", type=float, default=0.10, help="regressione ammessa, es. 0.10 = +10%%")
+    args = ap.parse_args(argv)
+
+    REPEAT = max(1, args.repeat)
+    suites = SUITES if "all" in args.suite else args.suite
+    # Con --json - lo stdout è del JSON: il testo va su stderr.
+    out: IO[str] = sys.stderr if args.json == "-" else sys.stdout
+    results: dict[str, Any] = {}
+
+    if "calc" in suites:
+        results["calc"] = bench_calc(args.sizes)
+        for r in results["calc"]:
+            print(
+                f"n={r['n']:>7}  total_monthly={r['total_monthly_s'] * 1e3:9.3f} ms  biggest_waste={r['biggest_waste_s'] * 1e3:9.3f} ms  "
+                f"cost_per_use={r['cost_per_use_s'] * 1e3:9.3f} ms  Portfolio={r['portfolio_s'] * 1e3:9.3f} ms",
+                file=out,
+            )
+    if "cents" in suites:
+        if not args.skip_check:
+            checked, mismatches = cents_mismatches()
+            if mismatches:
+                for m in mismatches[:20]:
+                    print(f"check_cents: {m}", file=sys.stderr)
+                print(f"check_cents: {len(mismatches)} differenze su {checked} abbonamenti", file=sys.stderr)
+                return 1
+            print(f"check_cents: {checked} abbonamenti confrontati, ok", file=out)
+        results["cents"] = bench_cents(args.sizes)
+        for r in results["cents"]:
+            print(f"n={r['n']:>7}  decimal={r['decimal_s'] * 1e3:9.3f} ms  cents={r['cents_s'] * 1e3:9.3f} ms  x{r['speedup']:.2f}", file=out)
+    if "poster" in suites:
+        results["poster"] = bench_poster(POSTER_SIZES)
+        for r in results["poster"]:
+            print(f"poster {r['size']:<10} {r['variant']:<12} {r['build_s'] * 1e3:8.1f} ms  {r['bytes'] / 1024:8.1f} KiB", file=out)
+    if "encode" in suites:
+        results["encode"] = bench_encodings()
+        for r in results["encode"]:
+            print(f"{r['encoding']:<12} {r['encode_s'] * 1e3:8.1f} ms  {r['bytes'] / 1024:8.1f} KiB", file=out)
+    if "catalog" in suites:
+        results["catalog"] = bench_catalog()
+        for r in results["catalog"]:
+            cold = f"  cold load {r['cold_load_s'] * 1e3:8.3f} ms" if "cold_load_s" in r else ""
+            print(f"catalogo {r['items']:>7} voci  parse {r['parse_s'] * 1e3:8.3f} ms{cold}", file=out)
+    if "startup" in suites:
+        r = results["startup"] = bench_startup()
+        for mod, t in r["imports_s"].items():
+            print(f"import {mod:<16} {t * 1e3:8.1f} ms", file=out)
+        fp = r["first_paint"]
+        print(f"first run {fp['first_run_s'] * 1e3:.1f} ms • rerun {fp['rerun_s'] * 1e3:.1f} ms • errori {fp['errors']}", file=out)
+        print("moduli caricati al primo run (guest): " + ", ".join(f"{m}={v}" for m, v in fp["loaded"].items()), file=out)
+
+    report: dict[str, Any] = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": REPEAT,
+        },
+        "results": results,
+        "metrics": metrics(results),
+    }
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare(report["metrics"], baseline.get("metrics", {}), args.threshold)
+        report["comparison"] = {"baseline": args.baseline, "threshold": args.threshold, "metrics": rows}
+        for c in rows:
+            flag = "REGRESSIONE" if c["regression"] else ""
+            print(f"{c['metric']:<48} {c['baseline_s'] * 1e3:9.3f} -> {c['current_s'] * 1e3:9.3f} ms  x{c['ratio']:.2f}  {flag}", file=out)
+        n_reg = sum(c["regression"] for c in rows)
+        print(f"{n_reg} regressioni su {len(rows)} misure (soglia +{args.threshold:.0%})", file=out)
+        status = 1 if n_reg else 0
+    if args.json:
+        text = json.dumps(report, indent=2)
+        if args.json == "-":
+            print(text)
+        else:
+            with open(args.json, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
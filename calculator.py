@@ -1,9 +1,18 @@
 from __future__ import annotations
 
+import heapq
+import re
 from datetime import date
 from decimal import Decimal, ROUND_HALF_UP
+from math import copysign, gcd
 from typing import Any, Iterable, Optional
 
+# Importo esatto in centesimi come frazione (numeratore, denominatore > 0):
+# annuale/12 e costo/uso restano esatti senza passare da Decimal.
+Cents = tuple[int, int]
+
+_CENTS_RE = re.compile(r"\s*([+-]?)(\d*)(?:\.(\d{0,2}))?\s*")
+
 
 def _d(x: Any) -> Decimal:
     if x is None or x == "":
@@ -15,46 +24,184 @@ def _d(x: Any) -> Decimal:
 
 
 def euro(amount: Any) -> str:
+    c = _parse_cents(amount)
+    if c is not None:
+        return euro_cents((c, 1))
     val = _d(amount).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
     s = f"{val:.2f}".replace(".", ",")
     return f"€{s}"
 
 
-def monthly_cost(sub: dict) -> Decimal:
+def _parse_cents(x: Any) -> Optional[int]:
+    # Fast path per int/float/str con al massimo 2 decimali; None = usa Decimal.
+    t = type(x)
+    if t is int:
+        return x * 100
+    if t is float:
+        # Se c/100 torna esattamente lo stesso float, repr(x) ha al massimo 2 decimali.
+        if -1e12 < x < 1e12:
+            c = round(x * 100)
+            if c / 100 == x and (c or copysign(1.0, x) > 0):
+                return c
+        return None
+    if t is str:
+        m = _CENTS_RE.fullmatch(x)
+        if m and (m.group(2) or m.group(3)):
+            c = int(m.group(2) or "0") * 100 + int((m.group(3) or "").ljust(2, "0"))
+            if m.group(1) == "-":
+                return -c if c else None
+            return c
+    return None
+
+
+def _to_cents(x: Any) -> Cents:
+    if x is None or x == "":
+        return (0, 1)
+    c = _parse_cents(x)
+    if c is not None:
+        return (c, 1)
+    d = _d(x)
+    if not d.is_finite():
+        return (0, 1)
+    n, den = d.as_integer_ratio()
+    n *= 100
+    g = gcd(n, den)
+    return (n // g, den // g)
+
+
+def _add_cents(a: Cents, b: Cents) -> Cents:
+    if a[1] == b[1]:
+        return (a[0] + b[0], a[1])
+    n = a[0] * b[1] + b[0] * a[1]
+    den = a[1] * b[1]
+    g = gcd(n, den)
+    return (n // g, den // g)
+
+
+def _lt_cents(a: Cents, b: Cents) -> bool:
+    return a[0] * b[1] < b[0] * a[1]
+
+
+class _CentsKey:
+    # Chiave di ordinamento esatta per Cents, a prodotti incrociati: stesso
+    # risultato di Fraction senza normalizzare (gcd) ogni valore.
+    __slots__ = ("num", "den")
+
+    def __init__(self, c: Cents):
+        self.num, self.den = c
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, _CentsKey):
+            return NotImplemented
+        return self.num * other.den == other.num * self.den
+
+    def __lt__(self, other: _CentsKey) -> bool:
+        return self.num * other.den < other.num * self.den
+
+
+def round_cents(c: Cents) -> int:
+    # ROUND_HALF_UP (lontano da zero), come euro().
+    num, den = c
+    if den == 1:
+        return num
+    q, r = divmod(abs(num), den)
+    if 2 * r >= den:
+        q += 1
+    return q if num >= 0 else -q
+
+
+def _near_half_cent(c: Cents) -> bool:
+    # Una somma esatta che cade (quasi) su mezzo centesimo può arrotondare in modo
+    # diverso dalla somma Decimal a 28 cifre: in quel caso si ricalcola con Decimal.
+    num, den = c
+    r = abs(num) % den
+    return abs(2 * r - den) * 10**9 <= den
+
+
+def euro_cents(c: Cents) -> str:
+    q = round_cents((abs(c[0]), c[1]))
+    sign = "-" if c[0] < 0 else ""
+    return f"€{sign}{q // 100},{q % 100:02d}"
+
+
+def cents_to_decimal(c: Cents) -> Decimal:
+    if c[1] == 1:
+        return Decimal(c[0]) / Decimal(100)
+    return Decimal(c[0]) / Decimal(c[1] * 100)
+
+
+def _costs(sub: dict) -> tuple[Decimal, Decimal]:
     tipo = (sub.get("tipo_pagamento") or "mensile").lower()
     pm = _d(sub.get("prezzo_mese"))
     pa = _d(sub.get("prezzo_anno_originale"))
     if tipo == "annuale":
         if pa > 0:
-            return (pa / Decimal("12"))
+            return (pa / Decimal("12")), pa
         if pm > 0:
-            return pm
-        return Decimal("0")
-    return pm
+            return pm, pm * Decimal("12")
+        return Decimal("0"), pm * Decimal("12")
+    return pm, pm * Decimal("12")
 
 
-def yearly_cost(sub: dict) -> Decimal:
+def _costs_cents(sub: dict) -> tuple[Cents, Cents]:
     tipo = (sub.get("tipo_pagamento") or "mensile").lower()
-    pm = _d(sub.get("prezzo_mese"))
-    pa = _d(sub.get("prezzo_anno_originale"))
+    pm = _to_cents(sub.get("prezzo_mese"))
+    pa = _to_cents(sub.get("prezzo_anno_originale"))
     if tipo == "annuale":
-        if pa > 0:
-            return pa
-        return pm * Decimal("12")
-    return pm * Decimal("12")
+        if pa[0] > 0:
+            return (pa[0], pa[1] * 12), pa
+        if pm[0] > 0:
+            return pm, (pm[0] * 12, pm[1])
+        return (0, 1), (pm[0] * 12, pm[1])
+    return pm, (pm[0] * 12, pm[1])
 
 
-def cost_per_use(sub: dict) -> Optional[Decimal]:
+def _uses(sub: dict) -> int:
     uses = sub.get("utilizzi_mese")
     try:
-        uses_i = int(uses) if uses not in (None, "") else 0
+        return int(uses) if uses not in (None, "") else 0
     except Exception:
-        uses_i = 0
+        return 0
+
+
+def monthly_cost(sub: dict) -> Decimal:
+    return _costs(sub)[0]
+
+
+def yearly_cost(sub: dict) -> Decimal:
+    return _costs(sub)[1]
+
+
+def cost_per_use(sub: dict) -> Optional[Decimal]:
+    uses_i = _uses(sub)
     if uses_i <= 0:
         return None
     return monthly_cost(sub) / Decimal(str(uses_i))
 
 
+def monthly_cost_cents(sub: dict) -> Cents:
+    return _costs_cents(sub)[0]
+
+
+def yearly_cost_cents(sub: dict) -> Cents:
+    return _costs_cents(sub)[1]
+
+
+def cost_per_use_cents(sub: dict) -> Optional[Cents]:
+    uses_i = _uses(sub)
+    if uses_i <= 0:
+        return None
+    m = monthly_cost_cents(sub)
+    return (m[0], m[1] * uses_i)
+
+
+def total_monthly_cents(subs: Iterable[dict]) -> Cents:
+    tot: Cents = (0, 1)
+    for s in subs:
+        tot = _add_cents(tot, monthly_cost_cents(s))
+    return tot
+
+
 def total_monthly(subs: Iterable[dict]) -> Decimal:
     tot = Decimal("0")
     for s in subs:
@@ -63,24 +210,137 @@ def total_monthly(subs: Iterable[dict]) -> Decimal:
 
 
 def biggest_waste(subs: list[dict]) -> Optional[dict]:
-    with_cpu = []
-    zero_use = []
+    # Un solo passaggio: costo/uso più alto; se nessuno ha utilizzi, costo mensile
+    # più alto. A parità vince il primo in lista.
+    best = best_cpu = None
+    fallback = fallback_mc = None
     for s in subs:
         cpu = cost_per_use(s)
-        if cpu is None:
-            zero_use.append(s)
-        else:
-            with_cpu.append((cpu, s))
+        if cpu is not None:
+            if best is None or cpu > best_cpu:
+                best, best_cpu = s, cpu
+        elif best is None:
+            mc = monthly_cost(s)
+            if fallback is None or mc > fallback_mc:
+                fallback, fallback_mc = s, mc
+    return best if best is not None else fallback
 
-    if with_cpu:
-        with_cpu.sort(key=lambda x: x[0], reverse=True)
-        return with_cpu[0][1]
 
-    if zero_use:
-        zero_use.sort(key=lambda x: monthly_cost(x), reverse=True)
-        return zero_use[0]
+class Portfolio:
+    # Colonne calcolate una sola volta per rerun: evita di ri-parsare ogni dict
+    # a ogni card/metrica. Gli indici seguono l'ordine di `subs`; i valori sono
+    # in centesimi esatti (vedi Cents), le versioni Decimal sono derivate.
+    def __init__(self, subs: Iterable[dict]):
+        self.subs: list[dict] = list(subs)
+        self.monthly_c: list[Cents] = []
+        self.yearly_c: list[Cents] = []
+        self.uses: list[int] = []
+        self.cpu_c: list[Optional[Cents]] = []
+        self.categories: list[str] = []
+        total: Cents = (0, 1)
+        for s in self.subs:
+            m, y = _costs_cents(s)
+            u = _uses(s)
+            self.monthly_c.append(m)
+            self.yearly_c.append(y)
+            self.uses.append(u)
+            self.cpu_c.append((m[0], m[1] * u) if u > 0 else None)
+            self.categories.append(s.get("categoria") or "Altro")
+            total = _add_cents(total, m)
+        self.total_monthly_c: Cents = total
 
-    return None
+    def __len__(self) -> int:
+        return len(self.subs)
+
+    @property
+    def total_monthly(self) -> Decimal:
+        c = self.total_monthly_c
+        if c[1] != 1 and _near_half_cent(c):
+            return total_monthly(self.subs)
+        return cents_to_decimal(c)
+
+    @property
+    def total_yearly(self) -> Decimal:
+        tot: Cents = (0, 1)
+        for y in self.yearly_c:
+            tot = _add_cents(tot, y)
+        return cents_to_decimal(tot)
+
+    @property
+    def monthly(self) -> list[Decimal]:
+        return [cents_to_decimal(m) for m in self.monthly_c]
+
+    @property
+    def cpu(self) -> list[Optional[Decimal]]:
+        return [cents_to_decimal(c) if c is not None else None for c in self.cpu_c]
+
+    def by_category(self) -> dict[str, Decimal]:
+        out: dict[str, Cents] = {}
+        for cat, m in zip(self.categories, self.monthly_c):
+            out[cat] = _add_cents(out.get(cat, (0, 1)), m)
+        return {cat: cents_to_decimal(c) for cat, c in out.items()}
+
+    def _waste_key(self, i: int) -> tuple[int, _CentsKey]:
+        # Prima chi ha un costo/uso (più alto = peggio), poi i non usati per costo
+        # mensile. Confronto esatto: niente float, che su importi enormi va in
+        # OverflowError e può far pari valori diversi.
+        c = self.cpu_c[i]
+        if c is not None:
+            return (1, _CentsKey(c))
+        return (0, _CentsKey(self.monthly_c[i]))
+
+    def top_k_waste(self, k: int) -> list[int]:
+        # Indici dei k peggiori, O(n log k); nlargest è stabile, quindi a parità vince il primo.
+        if k <= 0:
+            return []
+        return heapq.nlargest(k, range(len(self.subs)), key=self._waste_key)
+
+    def biggest_waste(self) -> Optional[dict]:
+        top = self.top_k_waste(1)
+        return self.subs[top[0]] if top else None
+
+    def summary(self) -> dict[str, Any]:
+        # Stessa forma dell'RPC subscription_summary (vedi supabase_client).
+        return {"monthly_total": self.total_monthly, "count": len(self.subs), "worst": self.biggest_waste()}
+
+    def cut_list(self, k: int = 5) -> list[dict[str, Any]]:
+        out = []
+        saving: Cents = (0, 1)
+        for i in self.top_k_waste(k):
+            saving = _add_cents(saving, self.monthly_c[i])
+            out.append({
+                "sub": self.subs[i],
+                "monthly": self.monthly_c[i],
+                "cpu": self.cpu_c[i],
+                "saving_cumulative": saving,
+            })
+        return out
+
+    def best_and_worst_cpu(self) -> tuple[Optional[tuple[Cents, dict]], Optional[tuple[Cents, dict]]]:
+        best_i = worst_i = None
+        for i, c in enumerate(self.cpu_c):
+            if c is None:
+                continue
+            if best_i is None or _lt_cents(c, self.cpu_c[best_i]):
+                best_i = i
+            if worst_i is None or not _lt_cents(c, self.cpu_c[worst_i]):
+                worst_i = i
+        if best_i is None:
+            return None, None
+        return (self.cpu_c[best_i], self.subs[best_i]), (self.cpu_c[worst_i], self.subs[worst_i])
+
+
+def top_k_waste(subs: Iterable[dict], k: int) -> list[dict]:
+    p = Portfolio(subs)
+    return [p.subs[i] for i in p.top_k_waste(k)]
+
+
+def best_and_worst_cpu(subs: Iterable[dict]) -> tuple[Optional[tuple[Cents, dict]], Optional[tuple[Cents, dict]]]:
+    return Portfolio(subs).best_and_worst_cpu()
+
+
+def cut_list(subs: Iterable[dict], k: int = 5) -> list[dict[str, Any]]:
+    return Portfolio(subs).cut_list(k)
 
 
 def xp_for_action(action: str) -> int:
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+from types import MappingProxyType
+from typing import Any, Mapping, Optional
+
+
+class PresetCatalog:
+    # Catalogo abbonamenti predefiniti, costruito una volta e condiviso in sola lettura
+    # tra le sessioni: record immutabili, lookup per nome O(1), indice per categoria
+    # e lista nomi già ordinata.
+    def __init__(self, raw: Mapping[str, Any]):
+        self.version = raw.get("version")
+        self.currency = raw.get("currency", "EUR")
+        items = []
+        by_name: dict[str, Mapping[str, Any]] = {}
+        by_category: dict[str, list[Mapping[str, Any]]] = {}
+        for it in raw.get("items", []) or []:
+            if not isinstance(it, Mapping):
+                continue
+            rec = MappingProxyType(dict(it))
+            items.append(rec)
+            nome = rec.get("nome")
+            if nome:
+                # Come la vecchia scansione lineare: a parità di nome vince il primo.
+                by_name.setdefault(nome, rec)
+            by_category.setdefault(rec.get("categoria") or "Altro", []).append(rec)
+        self.items: tuple[Mapping[str, Any], ...] = tuple(items)
+        self.names: tuple[str, ...] = tuple(sorted(by_name))
+        self._by_name = MappingProxyType(by_name)
+        self._by_category = MappingProxyType({k: tuple(v) for k, v in by_category.items()})
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._by_name
+
+    def by_name(self, name: str) -> Optional[Mapping[str, Any]]:
+        return self._by_name.get(name)
+
+    def by_category(self, categoria: str) -> tuple[Mapping[str, Any], ...]:
+        return self._by_category.get(categoria, ())
+
+    @property
+    def categories(self) -> tuple[str, ...]:
+        return tuple(sorted(self._by_category))
+
+
+_VERSION_RE = re.compile(rb'\s*\{\s*"version"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?)\s*[,}]')
+
+
+def _peek_version(content: bytes) -> Any:
+    # Solo se "version" è la prima chiave; altrimenti None e si parsa tutto.
+    m = _VERSION_RE.match(content, 0, 1024)
+    if not m:
+        return None
+    try:
+        return json.loads(m.group(1))
+    except ValueError:
+        return None
+
+
+class CatalogFetcher:
+    # Serve subito l'ultima copia buona (memoria -> cache su disco -> JSON locale)
+    # e, se il catalogo remoto è più vecchio di `max_age`, lo rivalida in background
+    # con If-None-Match / If-Modified-Since. Un catalogo con la stessa `version`
+    # non viene ricostruito.
+    def __init__(
+        self,
+        url: Optional[str],
+        cache_dir: Optional[str] = None,
+        local_path: str = "abbonamenti_predefiniti.json",
+        max_age: float = 3600,
+        timeout: float = 6,
+    ):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.local_path = local_path
+        self.max_age = max_age
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._catalog: Optional[PresetCatalog] = None
+        self._meta: dict[str, Any] = {}
+        self._refreshing = False
+
+    @property
+    def _data_path(self) -> str:
+        return os.path.join(self.cache_dir, "catalog.json")
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.cache_dir, "catalog.meta.json")
+
+    def current(self) -> PresetCatalog:
+        with self._lock:
+            if self._catalog is None:
+                self._catalog, self._meta = self._load_cold()
+            catalog = self._catalog
+            stale = bool(self.url) and time.time() - float(self._meta.get("fetched_at") or 0) > self.max_age
+            if stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh, name="catalog-refresh", daemon=True).start()
+        return catalog
+
+    def _load_cold(self) -> tuple[PresetCatalog, dict[str, Any]]:
+        if self.url and self.cache_dir:
+            try:
+                with open(self._meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("url") == self.url:
+                    with open(self._data_path, "r", encoding="utf-8") as f:
+                        return PresetCatalog(json.load(f)), meta
+            except (OSError, ValueError):
+                pass
+        try:
+            with open(self.local_path, "r", encoding="utf-8") as f:
+                return PresetCatalog(json.load(f)), {}
+        except (OSError, ValueError):
+            return PresetCatalog({"items": []}), {}
+
+    def _refresh(self) -> None:
+        try:
+            import requests
+
+            with self._lock:
+                meta = dict(self._meta)
+            headers = {}
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+            r = requests.get(self.url, headers=headers, timeout=self.timeout)
+            now = time.time()
+            if r.status_code == 304:
+                with self._lock:
+                    self._meta["fetched_at"] = now
+                    self._save_meta()
+                return
+            r.raise_for_status()
+            # La versione è la prima chiave del catalogo: se è quella già in uso
+            # non serve parsare tutto il body.
+            version = _peek_version(r.content)
+            with self._lock:
+                current = self._catalog.version
+            raw = None
+            if version is None or version != current:
+                raw = r.json()
+                version = raw.get("version")
+            changed = version is None or version != current
+            new_meta = {
+                "url": self.url,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "version": version,
+                "fetched_at": now,
+            }
+            with self._lock:
+                on_disk = self._meta.get("url") == self.url and self._meta.get("version") == version
+                if changed:
+                    self._catalog = PresetCatalog(raw)
+                self._meta = new_meta
+            # Prima i dati, poi i metadati: un meta su disco descrive sempre il
+            # catalog.json accanto, e un avvio a freddo non ripiega sul fetch completo.
+            if self.cache_dir and (changed or not on_disk or not os.path.exists(self._data_path)):
+                if raw is None:
+                    r.json()  # su disco solo JSON valido
+                if not self._save_data(r.content):
+                    return
+            with self._lock:
+                self._save_meta()
+        except Exception:
+            # Rete giù o JSON non valido: si continua a servire la copia che c'è.
+            with self._lock:
+                self._meta["fetched_at"] = time.time()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _atomic_write(self, path: str, data: bytes) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _save_meta(self) -> None:
+        if not self.cache_dir:
+            return
+        try:
+            self._atomic_write(self._meta_path, json.dumps(self._meta).encode("utf-8"))
+        except OSError:
+            pass
+
+    def _save_data(self, content: bytes) -> bool:
+        if not self.cache_dir:
+            return True
+        try:
+            self._atomic_write(self._data_path, content)
+        except OSError:
+            return False
+        return True
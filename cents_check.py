@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import random
+from typing import Any
+
+import calculator as calc
+
+# Differenziale: il percorso in centesimi deve dare gli stessi importi arrotondati
+# del percorso Decimal. Unica differenza ammessa: pareggi esatti nel ranking,
+# che Decimal può ordinare per rumore alla 28a cifra (in centesimi vince il primo).
+# Lo usano tests/test_cents.py e `python bench.py cents` prima di misurare.
+
+
+def fuzz_sub(rnd: random.Random) -> dict[str, Any]:
+    prices = [None, "", 0, -1, "abc", "1e3", " 2.5 ", "0.005", "12.345", "1.", ".5", 49.9, 1e-7, 100, 93.38]
+    return {
+        "tipo_pagamento": rnd.choice(["mensile", "annuale", "ANNUALE", None, ""]),
+        "prezzo_mese": rnd.choice(prices + [rnd.randint(-100, 30000) / 100, str(rnd.randint(0, 300000) / 1000)]),
+        "prezzo_anno_originale": rnd.choice(prices + [rnd.randint(0, 30000) / 100]),
+        "utilizzi_mese": rnd.choice([None, "", 0, 1, 2, 3, 7, "4", "x", -2, rnd.randint(1, 97)]),
+    }
+
+
+def sub_mismatches(s: dict[str, Any]) -> list[str]:
+    out = []
+    for what, cents, dec in (
+        ("monthly", calc.monthly_cost_cents(s), calc.monthly_cost(s)),
+        ("yearly", calc.yearly_cost_cents(s), calc.yearly_cost(s)),
+    ):
+        if calc.euro_cents(cents) != calc.euro(dec):
+            out.append(f"{what}: {calc.euro_cents(cents)} != {calc.euro(dec)} in {s!r}")
+    a, b = calc.cost_per_use_cents(s), calc.cost_per_use(s)
+    if (a is None) != (b is None):
+        out.append(f"cost_per_use: {a!r} vs {b!r} in {s!r}")
+    elif a is not None and calc.euro_cents(a) != calc.euro(b):
+        out.append(f"cost_per_use: {calc.euro_cents(a)} != {calc.euro(b)} in {s!r}")
+    for v in (s["prezzo_mese"], s["prezzo_anno_originale"]):
+        if calc.euro(v) != calc.euro(calc._d(v)):
+            out.append(f"euro: {calc.euro(v)} != {calc.euro(calc._d(v))} for {v!r}")
+    return out
+
+
+def portfolio_mismatches(subs: list[dict[str, Any]]) -> list[str]:
+    out = []
+    p = calc.Portfolio(subs)
+    if calc.euro(p.total_monthly) != calc.euro(calc.total_monthly(subs)):
+        out.append(f"total_monthly: {calc.euro(p.total_monthly)} != {calc.euro(calc.total_monthly(subs))} in {subs!r}")
+    w, legacy = p.biggest_waste(), calc.biggest_waste(subs)
+    if w is not legacy:
+        wc, lc = calc.cost_per_use_cents(w), calc.cost_per_use_cents(legacy)
+        if not (wc and lc and not calc._lt_cents(wc, lc) and not calc._lt_cents(lc, wc)):
+            out.append(f"biggest_waste: {w!r} != {legacy!r} in {subs!r}")
+    return out
+
+
+def cents_mismatches(rounds: int = 20_000, seed: int = 7) -> tuple[int, list[str]]:
+    rnd = random.Random(seed)
+    checked = 0
+    mismatches: list[str] = []
+    for _ in range(rounds):
+        subs = [fuzz_sub(rnd) for _ in range(rnd.randint(0, 8))]
+        for s in subs:
+            mismatches += sub_mismatches(s)
+            checked += 1
+        mismatches += portfolio_mismatches(subs)
+    return checked, mismatches
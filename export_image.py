@@ -1,64 +1,139 @@
 from __future__ import annotations
 
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 from io import BytesIO
-from typing import Any
+from typing import Any, Optional, Union
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 
 from calculator import euro
+from text_layout import font, truncate, wrap
+from tracing import traced
 
+FONT_PATH = "DejaVuSans.ttf"
 
-def _wrap(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.ImageFont, max_width: int) -> list[str]:
-    words = (text or "").split()
-    lines = []
-    cur = ""
-    for w in words:
-        test = (cur + " " + w).strip()
-        if draw.textlength(test, font=font) <= max_width:
-            cur = test
-        else:
-            if cur:
-                lines.append(cur)
-            cur = w
-    if cur:
-        lines.append(cur)
-    return lines
-
-
-def build_social_card(payload: dict[str, Any], size=(1080, 1920)) -> bytes:
+
+def _fit_value(value: str, f, max_width: float) -> str:
+    # "Nome • €x,xx": si accorcia il nome, l'importo resta sempre visibile.
+    head, sep, tail = value.rpartition(" • ")
+    if not sep:
+        return truncate(value, f, max_width)
+    tail = sep + tail
+    return truncate(head, f, max_width - f.getlength(tail)) + tail
+
+
+# Palette per tema: ogni tema ha il proprio layer statico pre-renderizzato.
+THEMES: dict[str, dict[str, tuple[int, int, int]]] = {
+    "dark": {
+        "bg": (11, 18, 32),
+        "panel": (15, 27, 46),
+        "panel_alt": (10, 20, 36),
+        "text": (229, 231, 235),
+        "muted": (156, 163, 175),
+        "accent": (34, 197, 94),
+    },
+    "light": {
+        "bg": (241, 245, 249),
+        "panel": (255, 255, 255),
+        "panel_alt": (226, 232, 240),
+        "text": (15, 23, 42),
+        "muted": (71, 85, 105),
+        "accent": (22, 163, 74),
+    },
+}
+DEFAULT_THEME = "dark"
+
+# Preset di encoding: "png" è il formato storico (lossless, lento); il poster usa
+# pochi colori, quindi la versione a palette pesa circa un terzo.
+ENCODINGS: dict[str, dict[str, Any]] = {
+    "png": {"format": "PNG", "optimize": True},
+    "png_fast": {"format": "PNG", "compress_level": 1},
+    "png_palette": {"format": "PNG", "optimize": True, "colors": 64},
+    "webp": {"format": "WEBP", "quality": 85, "method": 4},
+    "jpeg": {"format": "JPEG", "quality": 88, "subsampling": 0},
+}
+PREVIEW_ENCODING = "jpeg"
+DOWNLOAD_ENCODING = "png_palette"
+MIME_TYPES = {"PNG": "image/png", "WEBP": "image/webp", "JPEG": "image/jpeg"}
+
+
+@lru_cache(maxsize=16)
+def _static_layer(size: tuple[int, int], theme: str) -> Image.Image:
+    # Sfondo, pannelli ed etichette fisse: uguali per ogni poster con stessa size/tema.
     W, H = size
-    img = Image.new("RGB", size, (11, 18, 32))
+    c = THEMES[theme]
+    img = Image.new("RGB", size, c["bg"])
     draw = ImageDraw.Draw(img)
+    draw.rounded_rectangle((60, 60, W - 60, 220), radius=36, fill=c["panel"])
+    draw.rounded_rectangle((60, 260, W - 60, 1180), radius=46, fill=c["panel_alt"])
+    draw.rounded_rectangle((60, 1230, W - 60, 1520), radius=46, fill=c["panel"])
+    draw.text((90, 1260), "🏁 Challenge", font=font(FONT_PATH, 36), fill=c["muted"])
+    draw.rounded_rectangle((60, 1580, W - 60, 1860), radius=46, fill=c["panel_alt"])
+    return img
+
+
+def _encoding_options(encoding: Union[str, dict[str, Any]]) -> dict[str, Any]:
+    if isinstance(encoding, dict):
+        return dict(encoding)
+    return dict(ENCODINGS[encoding])
 
-    try:
-        title_font = ImageFont.truetype("DejaVuSans.ttf", 64)
-        big_font = ImageFont.truetype("DejaVuSans.ttf", 54)
-        mid_font = ImageFont.truetype("DejaVuSans.ttf", 36)
-        small_font = ImageFont.truetype("DejaVuSans.ttf", 28)
-    except Exception:
-        title_font = ImageFont.load_default()
-        big_font = ImageFont.load_default()
-        mid_font = ImageFont.load_default()
-        small_font = ImageFont.load_default()
 
-    draw.rounded_rectangle((60, 60, W - 60, 220), radius=36, fill=(15, 27, 46))
-    draw.text((90, 95), payload.get("title", "StreamSaver"), font=title_font, fill=(229, 231, 235))
+def encoding_mime(encoding: Union[str, dict[str, Any]]) -> tuple[str, str]:
+    fmt = _encoding_options(encoding).get("format", "PNG").upper()
+    return MIME_TYPES.get(fmt, "application/octet-stream"), fmt.lower().replace("jpeg", "jpg")
+
+
+def encode_image(img: Image.Image, encoding: Union[str, dict[str, Any]] = "png") -> bytes:
+    opts = _encoding_options(encoding)
+    fmt = opts.pop("format", "PNG").upper()
+    colors = opts.pop("colors", None)
+    if colors:
+        img = img.quantize(int(colors), method=Image.Quantize.FASTOCTREE)
+    out = BytesIO()
+    img.save(out, format=fmt, **opts)
+    return out.getvalue()
+
+
+def render_social_card(
+    payload: dict[str, Any],
+    size=(1080, 1920),
+    stamp: Optional[str] = None,
+    theme: str = DEFAULT_THEME,
+) -> Image.Image:
+    W, H = size
+    if theme not in THEMES:
+        theme = DEFAULT_THEME
+    c = THEMES[theme]
+    img = _static_layer(tuple(size), theme).copy()
+    draw = ImageDraw.Draw(img)
+
+    title_font = font(FONT_PATH, 64)
+    big_font = font(FONT_PATH, 54)
+    mid_font = font(FONT_PATH, 36)
+    small_font = font(FONT_PATH, 28)
+    text_w = W - 180
+
+    draw.text((90, 95), truncate(payload.get("title", "StreamSaver"), title_font, text_w), font=title_font, fill=c["text"])
 
     subtitle = payload.get("subtitle", "Costo per utilizzo = realtà.")
-    sub_lines = _wrap(draw, subtitle, mid_font, W - 180)
+    sub_lines = wrap(subtitle, mid_font, text_w)
     y = 170
     for line in sub_lines[:1]:
-        draw.text((90, y), line, font=mid_font, fill=(156, 163, 175))
+        draw.text((90, y), line, font=mid_font, fill=c["muted"])
 
-    draw.rounded_rectangle((60, 260, W - 60, 1180), radius=46, fill=(10, 20, 36))
     y = 300
 
     def metric(label: str, value: str, emoji: str = "✅"):
         nonlocal y
-        draw.text((90, y), f"{emoji}  {label}", font=mid_font, fill=(156, 163, 175))
+        draw.text((90, y), f"{emoji}  {label}", font=mid_font, fill=c["muted"])
         y += 46
-        draw.text((90, y), value, font=big_font, fill=(229, 231, 235))
+        draw.text((90, y), _fit_value(value, big_font, text_w), font=big_font, fill=c["text"])
         y += 86
 
     metric("Spesa mensile", euro(payload.get("monthly_total", 0)), "💸")
@@ -76,24 +151,173 @@ def build_social_card(payload: dict[str, Any], size=(1080, 1920)) -> bytes:
     if worst_cpu:
         metric("Peggior spreco (€/uso)", worst_cpu, "🧨")
 
-    draw.rounded_rectangle((60, 1230, W - 60, 1520), radius=46, fill=(15, 27, 46))
-    draw.text((90, 1260), "🏁 Challenge", font=mid_font, fill=(156, 163, 175))
-    draw.text((90, 1320), payload.get("challenge_title", "Nessuna challenge attiva"), font=big_font, fill=(229, 231, 235))
+    challenge_title = truncate(payload.get("challenge_title", "Nessuna challenge attiva"), big_font, text_w)
+    draw.text((90, 1320), challenge_title, font=big_font, fill=c["text"])
 
     streak = int(payload.get("streak_days", 0) or 0)
-    draw.text((90, 1400), f"Streak: {streak} giorni", font=mid_font, fill=(34, 197, 94))
+    draw.text((90, 1400), f"Streak: {streak} giorni", font=mid_font, fill=c["accent"])
 
-    draw.rounded_rectangle((60, 1580, W - 60, 1860), radius=46, fill=(10, 20, 36))
     footer = payload.get("footer", "Salva soldi. Condividi il poster. Ripeti.")
-    lines = _wrap(draw, footer, mid_font, W - 180)
+    lines = wrap(footer, mid_font, text_w)
     yy = 1620
     for line in lines[:3]:
-        draw.text((90, yy), line, font=mid_font, fill=(229, 231, 235))
+        draw.text((90, yy), line, font=mid_font, fill=c["text"])
         yy += 46
 
-    stamp = datetime.now().strftime("%d/%m/%Y")
-    draw.text((90, 1810), f"StreamSaver • {stamp}", font=small_font, fill=(156, 163, 175))
+    if stamp is None:
+        stamp = datetime.now().strftime("%d/%m/%Y")
+    draw.text((90, 1810), f"StreamSaver • {stamp}", font=small_font, fill=c["muted"])
+    return img
 
-    out = BytesIO()
-    img.save(out, format="PNG", optimize=True)
-    return out.getvalue()
+
+@traced(cat="poster")
+def build_social_card(
+    payload: dict[str, Any],
+    size=(1080, 1920),
+    stamp: Optional[str] = None,
+    theme: str = DEFAULT_THEME,
+    encoding: Union[str, dict[str, Any]] = "png",
+) -> bytes:
+    return encode_image(render_social_card(payload, size=size, stamp=stamp, theme=theme), encoding)
+
+
+def poster_key(
+    payload: dict[str, Any],
+    size=(1080, 1920),
+    stamp: Optional[str] = None,
+    theme: str = DEFAULT_THEME,
+    encoding: Union[str, dict[str, Any]] = "png",
+) -> str:
+    blob = json.dumps(
+        {
+            "payload": payload,
+            "size": list(size),
+            "stamp": stamp,
+            "theme": theme,
+            "encoding": _encoding_options(encoding),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class PosterCache:
+    # Due livelli: LRU in memoria (per numero di poster) e, opzionale, una cartella
+    # su disco con eviction dei file meno usati oltre `disk_max_bytes`.
+    def __init__(self, max_items: int = 64, disk_dir: Optional[str] = None, disk_max_bytes: int = 256 * 1024 * 1024):
+        self.max_items = max_items
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._mem: OrderedDict[str, bytes] = OrderedDict()
+        # Ultimo poster renderizzato: preview e download dello stesso payload
+        # cambiano solo l'encoding, quindi il disegno si fa una volta sola.
+        self._last_image: Optional[tuple[str, Image.Image]] = None
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.poster")
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                return data
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        self._remember(key, data)
+        if not self.disk_dir:
+            return
+        tmp = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            return
+        self._evict_disk()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            self._last_image = None
+
+    def last_image(self, render_key: str) -> Optional[Image.Image]:
+        with self._lock:
+            last = self._last_image
+        return last[1] if last and last[0] == render_key else None
+
+    def remember_image(self, render_key: str, img: Image.Image) -> None:
+        with self._lock:
+            self._last_image = (render_key, img)
+
+    def _remember(self, key: str, data: bytes) -> None:
+        with self._lock:
+            self._mem[key] = data
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_items:
+                self._mem.popitem(last=False)
+
+    def _evict_disk(self) -> None:
+        entries = []
+        total = 0
+        with os.scandir(self.disk_dir) as it:
+            for e in it:
+                if not e.name.endswith(".poster"):
+                    continue
+                try:
+                    info = e.stat()
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, e.path))
+                total += info.st_size
+        entries.sort()
+        for _, sz, path in entries:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= sz
+            except OSError:
+                pass
+
+
+_poster_cache = PosterCache()
+
+
+def cached_social_card(
+    payload: dict[str, Any],
+    size=(1080, 1920),
+    stamp: Optional[str] = None,
+    cache: Optional[PosterCache] = None,
+    theme: str = DEFAULT_THEME,
+    encoding: Union[str, dict[str, Any]] = "png",
+) -> bytes:
+    if stamp is None:
+        stamp = datetime.now().strftime("%d/%m/%Y")
+    cache = cache or _poster_cache
+    key = poster_key(payload, size, stamp, theme, encoding)
+    data = cache.get(key)
+    if data is None:
+        render_key = poster_key(payload, size, stamp, theme)
+        img = cache.last_image(render_key)
+        if img is None:
+            img = render_social_card(payload, size=size, stamp=stamp, theme=theme)
+            cache.remember_image(render_key, img)
+        data = encode_image(img, encoding)
+        cache.put(key, data)
+    return data
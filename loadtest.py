@@ -0,0 +1,479 @@
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, ContextManager, Optional
+
+import supabase_client
+from storage import MemoryStorage
+from tracing import traced
+
+# Load test headless: N sessioni simulate di app.py in parallelo, una per thread
+# come nel server Streamlit, guidate da AppTest contro un Supabase finto
+# in-process (latenza ed errori configurabili, nessuna rete). Per ogni livello di
+# sessioni: percentili di latenza delle interazioni, throughput, memoria per sessione.
+#
+#   python loadtest.py --sessions 1 5 10 20 40 --latency 40 --jitter 15
+#   python loadtest.py --sessions 25 --error-rate 0.02 --think 0.5 --json report.json
+#   python loadtest.py --sessions 10 20 40 80 --p99-limit 2000   exit 1 oltre la soglia
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+PRESETS = ["Netflix", "Disney+", "DAZN", "Spotify Premium", "Amazon Prime Video", "NOW"]
+PERCENTILES = (50, 90, 95, 99)
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeSupabase:
+    # Stesse firme delle funzioni di supabase_client, dati in una MemoryStorage.
+    # Ogni chiamata "di rete" aspetta latency ± jitter ms e fallisce con
+    # probabilità error_rate, come farebbe un Supabase lento o instabile.
+    API = (
+        "supabase_enabled",
+        "_authed_client",
+        "release_client",
+        "sign_up",
+        "sign_in",
+        "sign_out",
+        "fetch_subscriptions",
+        "fetch_subscriptions_page",
+        "fetch_subscription_summary",
+        "fetch_subscription_changes",
+        "upsert_subscription",
+        "upsert_subscriptions",
+        "delete_subscription",
+        "delete_subscriptions",
+        "fetch_profile",
+        "upsert_profile",
+        "increment_xp",
+        "fetch_challenge",
+        "upsert_challenge",
+    )
+    LOCAL = ("supabase_enabled", "_authed_client", "release_client")
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.store = MemoryStorage()
+        self.calls: Counter[str] = Counter()
+        self.injected: Counter[str] = Counter()
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tombstones: dict[str, list[dict[str, Any]]] = {}
+
+    def _net(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+            delay = max(0.0, self._rnd.gauss(self.latency_ms, self.jitter_ms)) / 1000 if self.latency_ms or self.jitter_ms else 0.0
+            fail = self._rnd.random() < self.error_rate
+            if fail:
+                self.injected[name] += 1
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise ConnectionError(f"{name}: errore iniettato")
+
+    @staticmethod
+    def _uid(access_token: str) -> str:
+        return access_token[len("tok-"):]
+
+    def install(self) -> Callable[[], None]:
+        # Sostituisce le funzioni del modulo (anche quelle chiamate dentro
+        # load_bundle e da storage.py); restituisce la funzione che le ripristina.
+        saved = {name: getattr(supabase_client, name) for name in self.API}
+        for name in self.API:
+            fn = getattr(self, name)
+            if name not in self.LOCAL:
+                fn = traced(f"supabase_client.{name}", "supabase")(fn)
+            setattr(supabase_client, name, fn)
+        return lambda: [setattr(supabase_client, name, fn) for name, fn in saved.items()]
+
+    def supabase_enabled(self) -> bool:
+        return True
+
+    def _authed_client(self, access_token: str) -> ContextManager[None]:
+        return nullcontext()
+
+    def release_client(self, access_token: str) -> None:
+        return None
+
+    def _auth(self, email: str) -> dict[str, Any]:
+        uid = f"u-{uuid.uuid5(uuid.NAMESPACE_URL, email).hex[:12]}"
+        return {"user": SimpleNamespace(id=uid, email=email), "session": SimpleNamespace(access_token=f"tok-{uid}")}
+
+    def sign_up(self, email: str, password: str) -> dict[str, Any]:
+        self._net("sign_up")
+        return self._auth(email)
+
+    def sign_in(self, email: str, password: str) -> dict[str, Any]:
+        self._net("sign_in")
+        return self._auth(email)
+
+    def sign_out(self, access_token: str) -> None:
+        self._net("sign_out")
+
+    def fetch_subscriptions(self, access_token: str, user_id: str, columns: str = "*") -> list[dict]:
+        self._net("fetch_subscriptions")
+        return [dict(r) for r in self.store.list_subscriptions(user_id)]
+
+    def fetch_subscriptions_page(self, access_token: str, user_id: str, offset: int, limit: int, columns: str = "") -> list[dict]:
+        self._net("fetch_subscriptions_page")
+        return [dict(r) for r in self.store.page_subscriptions(user_id, offset, limit)]
+
+    def fetch_subscription_summary(self, access_token: str) -> dict[str, Any]:
+        self._net("fetch_subscription_summary")
+        return self.store.summary(self._uid(access_token))
+
+    def fetch_subscription_changes(self, access_token: str, user_id: str, since: str) -> dict[str, list]:
+        self._net("fetch_subscription_changes")
+        rows = [dict(r) for r in self.store.list_subscriptions(user_id) if str(r.get("updated_at") or "") > since]
+        with self._lock:
+            deleted = [dict(t) for t in self._tombstones.get(user_id, []) if t["deleted_at"] > since]
+        return {"rows": rows, "deleted": deleted}
+
+    def upsert_subscription(self, access_token: str, row: dict) -> dict:
+        self._net("upsert_subscription")
+        return self.store.upsert_subscription(self._uid(access_token), {**row, "updated_at": _now_iso()})
+
+    def upsert_subscriptions(self, access_token: str, rows: list[dict], chunk_size: int = 0) -> dict[str, list]:
+        self._net("upsert_subscriptions")
+        uid = self._uid(access_token)
+        return {"saved": [self.store.upsert_subscription(uid, {**r, "updated_at": _now_iso()}) for r in rows], "failed": []}
+
+    def _delete(self, sub_ids: list[str], user_id: str) -> None:
+        for sub_id in sub_ids:
+            self.store.delete_subscription(user_id, sub_id)
+        with self._lock:
+            self._tombstones.setdefault(user_id, []).extend({"id": s, "deleted_at": _now_iso()} for s in sub_ids)
+
+    def delete_subscription(self, access_token: str, sub_id: str, user_id: str) -> None:
+        self._net("delete_subscription")
+        self._delete([sub_id], user_id)
+
+    def delete_subscriptions(self, access_token: str, sub_ids: list[str], user_id: str, chunk_size: int = 0) -> dict[str, list]:
+        self._net("delete_subscriptions")
+        self._delete(list(sub_ids), user_id)
+        return {"deleted": list(sub_ids), "failed": []}
+
+    def fetch_profile(self, access_token: str, user_id: str) -> dict:
+        self._net("fetch_profile")
+        return {**self.store.get_profile(user_id), "user_id": user_id}
+
+    def upsert_profile(self, access_token: str, row: dict) -> dict:
+        self._net("upsert_profile")
+        uid = self._uid(access_token)
+        return {**self.store.save_profile(uid, row), "user_id": uid}
+
+    def increment_xp(self, access_token: str, delta: int) -> int:
+        self._net("increment_xp")
+        return self.store.increment_xp(self._uid(access_token), delta)
+
+    def fetch_challenge(self, access_token: str, user_id: str) -> dict:
+        self._net("fetch_challenge")
+        return self.store.get_challenge(user_id)
+
+    def upsert_challenge(self, access_token: str, row: dict) -> dict:
+        self._net("upsert_challenge")
+        return self.store.save_challenge(self._uid(access_token), row)
+
+
+def prepare_apptest(secrets: dict[str, Any]) -> None:
+    # AppTest è pensato per un test alla volta: a ogni run imposta e poi azzera
+    # stato globale (Runtime, secrets, config "global.appTest") e ricompila lo
+    # script. Con più sessioni in parallelo un run azzererebbe quello degli altri;
+    # qui quello stato diventa unico per il processo, come nel server vero (un
+    # Runtime, un solo bytecode in cache, gli stessi secrets per tutti).
+    import streamlit as st
+    import streamlit.testing.v1.app_test as app_test
+    import streamlit.testing.v1.local_script_runner as local_script_runner
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.secrets import Secrets
+
+    config.set_option("global.appTest", True)
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+
+    class SharedRuntime:
+        # Il primo Runtime finto creato resta quello di tutti; gli azzeramenti a
+        # fine run vengono ignorati.
+        def __getattr__(self, name: str) -> Any:
+            return getattr(Runtime, name)
+
+        def __dir__(self) -> list[str]:
+            return dir(Runtime)
+
+        def __setattr__(self, name: str, value: Any) -> None:
+            if name != "_instance":
+                setattr(Runtime, name, value)
+            elif value is not None and Runtime._instance is None:
+                Runtime._instance = value
+
+    app_test.Runtime = SharedRuntime()
+    shared = Secrets()
+    shared._secrets = dict(secrets)
+    st.secrets = shared
+    # Warning e traceback di ogni run coprirebbero il report: gli errori finiscono
+    # già contati e riassunti nei risultati.
+    for name in ["streamlit"] + [n for n in logging.root.manager.loggerDict if n.startswith("streamlit.")]:
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+
+
+class SessionError(Exception):
+    pass
+
+
+def _button(at, label_prefix: str):
+    for b in at.button:
+        if b.label.startswith(label_prefix):
+            return b
+    raise SessionError(f"bottone '{label_prefix}' non trovato")
+
+
+def _preset_select(at, name: str):
+    for s in at.selectbox:
+        if name in s.options:
+            return s
+    raise SessionError(f"selectbox con '{name}' non trovata")
+
+
+def _login(at, email: str) -> None:
+    fields = {t.label: t for t in at.text_input}
+    if "Email" not in fields or "Password" not in fields:
+        raise SessionError("form di login non trovato")
+    fields["Email"].input(email)
+    fields["Password"].input("loadtest")
+    _button(at, "Login").click().run()
+    if at.session_state["mode"] != "authed":
+        raise SessionError("login fallito")
+
+
+def _add(at, name: str) -> None:
+    _preset_select(at, name).select(name).run()
+    if at.exception:
+        return
+    _button(at, "Aggiungi").click().run()
+
+
+def _challenge(at) -> None:
+    _button(at, "🚀 Avvia challenge").click().run()
+    if at.exception:
+        return
+    _button(at, "✅ Check-in").click().run()
+
+
+def run_session(
+    user: str,
+    index: int,
+    iterations: int,
+    think: float,
+    timeout: float,
+    record: Callable[[str, float, Optional[str]], None],
+    keep: list,
+) -> None:
+    from streamlit.testing.v1 import AppTest
+
+    rnd = random.Random(index)
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    keep.append(at)
+
+    def step(name: str, action: Callable[[], Any]) -> bool:
+        start = time.perf_counter()
+        error = None
+        try:
+            action()
+            if at.exception:
+                error = at.exception[0].message.splitlines()[0] if at.exception[0].message else "eccezione nell'app"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        record(name, time.perf_counter() - start, error)
+        if think:
+            time.sleep(rnd.expovariate(1 / think))
+        return error is None
+
+    step("open", at.run)
+    if not step("login", lambda: _login(at, f"{user}@example.com")):
+        return
+    for it in range(iterations):
+        step("add_subscription", lambda: _add(at, PRESETS[(index + it) % len(PRESETS)]))
+        if it == 0:
+            step("challenge_checkin", lambda: _challenge(at))
+        step("export", lambda: _button(at, "✅ Segna Export").click().run())
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def percentile(values: list[float], p: float) -> float:
+    # Nearest-rank: il valore sotto cui cade il p% delle misure.
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[max(0, min(len(s) - 1, int(round(p / 100 * len(s) + 0.5)) - 1))]
+
+
+def _latency_stats(values: list[float]) -> dict[str, float]:
+    stats = {f"p{p}_ms": percentile(values, p) * 1e3 for p in PERCENTILES}
+    stats["max_ms"] = max(values, default=0.0) * 1e3
+    return stats
+
+
+def run_level(sessions: int, args: argparse.Namespace, fake: FakeSupabase) -> dict[str, Any]:
+    samples: list[tuple[str, float, Optional[str]]] = []
+    lock = threading.Lock()
+    keep: list = []
+
+    def record(step: str, elapsed: float, error: Optional[str]) -> None:
+        with lock:
+            samples.append((step, elapsed, error))
+
+    # Utenti nuovi a ogni livello: nessuno parte con dati o challenge già attive.
+    run_id = uuid.uuid4().hex[:6]
+    calls_before = Counter(fake.calls)
+    gc.collect()
+    if args.tracemalloc:
+        tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0] if args.tracemalloc else _rss_bytes()
+
+    threads = [
+        threading.Thread(
+            target=run_session,
+            args=(f"loadtest-{run_id}-{i}", i, args.iterations, args.think, args.timeout, record, keep),
+            name=f"loadtest-{i}",
+            daemon=True,
+        )
+        for i in range(sessions)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    # Sessioni ancora vive (AppTest in `keep`): la differenza è la loro memoria,
+    # albero degli elementi di AppTest compreso (stima per eccesso).
+    gc.collect()
+    mem_after = tracemalloc.get_traced_memory()[0] if args.tracemalloc else _rss_bytes()
+    if args.tracemalloc:
+        tracemalloc.stop()
+    per_session = (mem_after - mem_before) / sessions if mem_before is not None and mem_after is not None else None
+    del keep
+
+    latencies = [s[1] for s in samples]
+    errors = [s for s in samples if s[2]]
+    by_step: dict[str, list[float]] = {}
+    for name, elapsed, _ in samples:
+        by_step.setdefault(name, []).append(elapsed)
+    return {
+        "sessions": sessions,
+        "interactions": len(samples),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(samples) if samples else 0.0,
+        "error_samples": dict(Counter(e[2] for e in errors).most_common(5)),
+        "wall_s": wall,
+        "throughput_per_s": len(samples) / wall if wall > 0 else 0.0,
+        "latency": _latency_stats(latencies),
+        "steps": {name: {"count": len(v), **_latency_stats(v)} for name, v in by_step.items()},
+        "memory_per_session_mb": per_session / 2**20 if per_session is not None else None,
+        "memory_source": "tracemalloc" if args.tracemalloc else "rss",
+        "backend_calls": dict(Counter(fake.calls) - calls_before),
+    }
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Load test headless di app.py (AppTest + Supabase finto)")
+    ap.add_argument("--sessions", type=int, nargs="+", default=[1, 5, 10], help="livelli di sessioni concorrenti, in ordine")
+    ap.add_argument("--iterations", type=int, default=3, help="giri add + export per sessione dopo login e challenge")
+    ap.add_argument("--think", type=float, default=0.0, help="pausa media tra interazioni in secondi (esponenziale)")
+    ap.add_argument("--latency", type=float, default=30.0, help="latenza media per chiamata Supabase, ms")
+    ap.add_argument("--jitter", type=float, default=10.0, help="deviazione standard della latenza, ms")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="probabilità di errore per chiamata (0-1)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--timeout", type=float, default=120.0, help="timeout per singolo run di AppTest, s")
+    ap.add_argument("--tracemalloc", action="store_true", help="memoria per sessione dall'heap Python invece che da RSS (più lento)")
+    ap.add_argument("--secret", action="append", default=[], metavar="KEY=VALUE", help="secrets per l'app, ripetibile")
+    ap.add_argument("--p99-limit", type=float, help="soglia p99 in ms: exit 1 se un livello la supera")
+    ap.add_argument("--json", metavar="PATH", help="scrive il report in JSON ('-' per stdout)")
+    args = ap.parse_args(argv)
+
+    out = sys.stderr if args.json == "-" else sys.stdout
+    secrets = dict(s.split("=", 1) for s in args.secret)
+    prepare_apptest(secrets)
+    fake = FakeSupabase(args.latency, args.jitter, args.error_rate, seed=args.seed)
+    restore = fake.install()
+    levels = []
+    try:
+        # Giro a vuoto: import, compilazione dello script, cache_resource e font.
+        warm = argparse.Namespace(**{**vars(args), "iterations": 1, "think": 0.0, "tracemalloc": False})
+        run_level(1, warm, fake)
+        for n in args.sessions:
+            r = run_level(n, args, fake)
+            levels.append(r)
+            lat = r["latency"]
+            mem = f"{r['memory_per_session_mb']:.2f} MiB/sessione" if r["memory_per_session_mb"] is not None else "memoria n/d"
+            print(
+                f"sessioni={n:>4}  interazioni={r['interactions']:>5}  errori={r['errors']:>3} ({r['error_rate']:.1%})  "
+                f"{r['throughput_per_s']:7.2f}/s  p50={lat['p50_ms']:8.1f}  p95={lat['p95_ms']:8.1f}  "
+                f"p99={lat['p99_ms']:8.1f}  max={lat['max_ms']:8.1f} ms  {mem}",
+                file=out,
+            )
+            for msg, count in r["error_samples"].items():
+                print(f"    {count}× {msg}", file=out)
+    finally:
+        restore()
+
+    status = 0
+    knee = None
+    if args.p99_limit is not None:
+        knee = next((r["sessions"] for r in levels if r["latency"]["p99_ms"] > args.p99_limit), None)
+        if knee is None:
+            print(f"p99 sotto {args.p99_limit:g} ms a tutti i livelli", file=out)
+        else:
+            print(f"p99 oltre {args.p99_limit:g} ms da {knee} sessioni", file=out)
+            status = 1
+    if args.json:
+        report = {
+            "meta": {
+                "created_at": _now_iso(),
+                "python": sys.version.split()[0],
+                "cpus": os.cpu_count(),
+                "config": {k: v for k, v in vars(args).items() if k not in ("json", "secret")},
+            },
+            "levels": levels,
+            "p99_limit_ms": args.p99_limit,
+            "p99_exceeded_at": knee,
+        }
+        text = json.dumps(report, indent=2)
+        if args.json == "-":
+            print(text)
+        else:
+            with open(args.json, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from datetime import date
+from typing import Any, Iterator, Optional
+
+from export_image import DEFAULT_THEME, ENCODINGS, build_social_card, encoding_mime
+
+# Render offline dei poster (es. recap settimanale per tutti gli utenti).
+# Input: JSONL, un payload per riga con la stessa forma del `payload` del tab Export;
+# la chiave opzionale "id" dà il nome al file.
+#
+#   python render_posters.py payloads.jsonl --out posters/ --workers 4
+#   cat payloads.jsonl | python render_posters.py - --tar - > posters.tar
+
+_SAFE_NAME = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def _read_jobs(stream: io.TextIOBase) -> Iterator[tuple[str, Optional[dict[str, Any]], Optional[str]]]:
+    for lineno, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            payload = json.loads(line)
+            if not isinstance(payload, dict):
+                raise ValueError("la riga non è un oggetto JSON")
+        except ValueError as e:
+            yield str(lineno), None, f"riga {lineno}: {e}"
+            continue
+        name = _SAFE_NAME.sub("_", str(payload.get("id") or lineno))
+        yield name, payload, None
+
+
+def _render(name: str, payload: dict[str, Any], size: tuple[int, int], stamp: str, theme: str, encoding: str) -> tuple[str, bytes]:
+    return name, build_social_card(payload, size=size, stamp=stamp, theme=theme, encoding=encoding)
+
+
+class _Sink:
+    def __init__(self, out_dir: Optional[str], tar_path: Optional[str], zip_path: Optional[str]):
+        self._tar = self._zip = None
+        self.out_dir = out_dir
+        if tar_path:
+            fileobj = sys.stdout.buffer if tar_path == "-" else open(tar_path, "wb")
+            self._tar = tarfile.open(fileobj=fileobj, mode="w|")
+            self._tar_file = fileobj
+        elif zip_path:
+            fileobj = sys.stdout.buffer if zip_path == "-" else open(zip_path, "wb")
+            self._zip = zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_STORED)
+            self._zip_file = fileobj
+        elif out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, filename: str, data: bytes) -> None:
+        if self._tar is not None:
+            info = tarfile.TarInfo(filename)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(data))
+        elif self._zip is not None:
+            self._zip.writestr(filename, data)
+        elif self.out_dir:
+            with open(os.path.join(self.out_dir, filename), "wb") as f:
+                f.write(data)
+
+    def close(self) -> None:
+        if self._tar is not None:
+            self._tar.close()
+            if self._tar_file is not sys.stdout.buffer:
+                self._tar_file.close()
+        if self._zip is not None:
+            self._zip.close()
+            if self._zip_file is not sys.stdout.buffer:
+                self._zip_file.close()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Render batch dei poster StreamSaver da JSONL")
+    ap.add_argument("input", help="file JSONL con i payload, '-' per stdin")
+    dest = ap.add_mutually_exclusive_group(required=True)
+    dest.add_argument("--out", help="cartella di output (un file per poster)")
+    dest.add_argument("--tar", help="archivio tar in streaming ('-' per stdout)")
+    dest.add_argument("--zip", help="archivio zip ('-' per stdout)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--max-in-flight", type=int, default=0, help="poster in coda al massimo (default: 2 × workers)")
+    ap.add_argument("--encoding", choices=sorted(ENCODINGS), default="png_palette")
+    ap.add_argument("--theme", default=DEFAULT_THEME)
+    ap.add_argument("--size", type=int, nargs=2, default=(1080, 1920), metavar=("W", "H"))
+    ap.add_argument("--stamp", default=date.today().strftime("%d/%m/%Y"))
+    args = ap.parse_args(argv)
+
+    workers = max(1, args.workers)
+    max_in_flight = args.max_in_flight or workers * 2
+    _, ext = encoding_mime(args.encoding)
+    size = tuple(args.size)
+
+    stream = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    sink = _Sink(args.out, args.tar, args.zip)
+    done = failed = 0
+    start = time.perf_counter()
+
+    def collect(futures: set[Future]) -> None:
+        nonlocal done, failed
+        for fut in futures:
+            try:
+                name, data = fut.result()
+            except Exception as e:
+                failed += 1
+                print(f"render fallito: {e}", file=sys.stderr)
+                continue
+            sink.write(f"poster_{name}.{ext}", data)
+            done += 1
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending: set[Future] = set()
+            for name, payload, err in _read_jobs(stream):
+                if err:
+                    failed += 1
+                    print(err, file=sys.stderr)
+                    continue
+                # Backpressure: l'input si legge solo quando c'è posto in coda.
+                if len(pending) >= max_in_flight:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                pending.add(pool.submit(_render, name, payload, size, args.stamp, args.theme, args.encoding))
+            finished, _ = wait(pending)
+            collect(finished)
+    finally:
+        sink.close()
+        if stream is not sys.stdin:
+            stream.close()
+
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(
+        f"{done} poster in {elapsed:.2f}s ({failed} errori) • {rate:.2f} poster/s • {rate / workers:.2f} poster/s per core",
+        file=sys.stderr,
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,411 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Iterable, Optional
+
+import supabase_client
+from calculator import Portfolio, level_from_xp, xp_for_action
+from subs_cache import DeltaSync, SubscriptionCache
+
+DEFAULT_PROFILE = {"budget_mese": 0.0, "xp": 0}
+
+
+def new_local_id() -> str:
+    return f"local-{uuid.uuid4().hex}"
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Storage(ABC):
+    # Unico punto di accesso ai dati per la UI. Le liste restituite vanno trattate
+    # in sola lettura: per modificare si passa da upsert_*/delete_*.
+
+    @abstractmethod
+    def list_subscriptions(self, user_id: str) -> list[dict]: ...
+
+    @abstractmethod
+    def upsert_subscription(self, user_id: str, row: dict) -> dict: ...
+
+    @abstractmethod
+    def delete_subscription(self, user_id: str, sub_id: str) -> None: ...
+
+    @abstractmethod
+    def get_profile(self, user_id: str) -> dict: ...
+
+    @abstractmethod
+    def save_profile(self, user_id: str, row: dict) -> dict: ...
+
+    @abstractmethod
+    def increment_xp(self, user_id: str, delta: int) -> int: ...
+
+    @abstractmethod
+    def get_challenge(self, user_id: str) -> dict: ...
+
+    @abstractmethod
+    def save_challenge(self, user_id: str, row: dict) -> dict: ...
+
+    def subscriptions_ready(self, user_id: str) -> bool:
+        # False se list_subscriptions dovrebbe aspettare la rete.
+        return True
+
+    def page_subscriptions(self, user_id: str, offset: int, limit: int) -> list[dict]:
+        return self.list_subscriptions(user_id)[offset:offset + limit]
+
+    def summary(self, user_id: str) -> dict[str, Any]:
+        return Portfolio(self.list_subscriptions(user_id)).summary()
+
+    def upsert_subscriptions(self, user_id: str, rows: list[dict]) -> dict[str, list]:
+        saved, failed = [], []
+        for row in rows:
+            try:
+                saved.append(self.upsert_subscription(user_id, row))
+            except Exception as e:
+                failed.append({"rows": [row], "error": str(e)})
+        return {"saved": saved, "failed": failed}
+
+    def award_xp(self, user_id: str, actions: Iterable[str]) -> Optional[dict[str, int]]:
+        # Tutti i premi di un'interazione in un solo incremento.
+        delta = sum(xp_for_action(a) for a in actions)
+        if not delta:
+            return None
+        xp = self.increment_xp(user_id, delta)
+        lvl, to_next = level_from_xp(xp)
+        return {"xp": xp, "delta": delta, "level": lvl, "to_next": to_next}
+
+    def prefetch(self, user_id: str, parts: Iterable[str]) -> dict[str, Any]:
+        # Gancio per i backend remoti: carica in anticipo (e in parallelo) profilo
+        # e challenge richiesti. I backend locali non ne hanno bisogno.
+        return {}
+
+
+class MemoryStorage(Storage):
+    # Tutto in memoria di processo (guest mode, benchmark). Abbonamenti indicizzati
+    # per id in un OrderedDict con i più recenti in testa: update e delete O(1).
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs: dict[str, OrderedDict[str, dict]] = {}
+        self._profiles: dict[str, dict] = {}
+        self._challenges: dict[str, dict] = {}
+
+    def list_subscriptions(self, user_id: str) -> list[dict]:
+        with self._lock:
+            return list(self._subs.get(user_id, {}).values())
+
+    def upsert_subscription(self, user_id: str, row: dict) -> dict:
+        row = dict(row)
+        row["id"] = row.get("id") or new_local_id()
+        row["user_id"] = user_id
+        with self._lock:
+            subs = self._subs.setdefault(user_id, OrderedDict())
+            old = subs.get(row["id"])
+            if old is not None:
+                row = {**old, **row}
+                subs[row["id"]] = row
+            else:
+                row.setdefault("data_aggiunto", _now_iso())
+                subs[row["id"]] = row
+                subs.move_to_end(row["id"], last=False)
+        return row
+
+    def delete_subscription(self, user_id: str, sub_id: str) -> None:
+        with self._lock:
+            self._subs.get(user_id, {}).pop(sub_id, None)
+
+    def get_profile(self, user_id: str) -> dict:
+        with self._lock:
+            return dict(self._profiles.get(user_id) or DEFAULT_PROFILE)
+
+    def save_profile(self, user_id: str, row: dict) -> dict:
+        with self._lock:
+            old = self._profiles.get(user_id) or DEFAULT_PROFILE
+            prof = {**old, **{k: v for k, v in row.items() if k != "xp"}, "xp": int(old.get("xp") or 0)}
+            self._profiles[user_id] = prof
+            return dict(prof)
+
+    def increment_xp(self, user_id: str, delta: int) -> int:
+        with self._lock:
+            prof = dict(self._profiles.get(user_id) or DEFAULT_PROFILE)
+            prof["xp"] = int(prof.get("xp") or 0) + int(delta)
+            self._profiles[user_id] = prof
+            return prof["xp"]
+
+    def get_challenge(self, user_id: str) -> dict:
+        with self._lock:
+            return dict(self._challenges.get(user_id) or {})
+
+    def save_challenge(self, user_id: str, row: dict) -> dict:
+        with self._lock:
+            self._challenges[user_id] = dict(row)
+            return dict(row)
+
+
+_SQLITE_SCHEMA = """
+create table if not exists subscriptions (
+    id text primary key,
+    user_id text not null,
+    nome text,
+    categoria text,
+    data_rinnovo text,
+    data_aggiunto text not null,
+    data text not null
+);
+create index if not exists subscriptions_user on subscriptions (user_id, data_aggiunto desc);
+create table if not exists profiles (user_id text primary key, data text not null, xp integer not null default 0);
+create table if not exists challenges (user_id text primary key, data text not null);
+"""
+
+
+class SQLiteStorage(Storage):
+    # Store locale su file (offline / self-hosted). Una connessione condivisa
+    # protetta da lock; le righe sono JSON, con le colonne indicizzate estratte.
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("pragma journal_mode=wal")
+            self._conn.executescript(_SQLITE_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _select(self, sql: str, args: tuple) -> list[dict]:
+        with self._lock:
+            return [json.loads(r[0]) for r in self._conn.execute(sql, args)]
+
+    def list_subscriptions(self, user_id: str) -> list[dict]:
+        return self._select("select data from subscriptions where user_id = ? order by data_aggiunto desc, rowid desc", (user_id,))
+
+    def page_subscriptions(self, user_id: str, offset: int, limit: int) -> list[dict]:
+        return self._select(
+            "select data from subscriptions where user_id = ? order by data_aggiunto desc, rowid desc limit ? offset ?",
+            (user_id, limit, offset),
+        )
+
+    def _upsert(self, user_id: str, row: dict) -> dict:
+        # Chiamare con il lock preso e dentro una transazione.
+        row = dict(row)
+        row["id"] = row.get("id") or new_local_id()
+        row["user_id"] = user_id
+        old = self._conn.execute("select data, user_id from subscriptions where id = ?", (row["id"],)).fetchone()
+        if old is not None:
+            if old[1] != user_id:
+                raise PermissionError("abbonamento di un altro utente")
+            row = {**json.loads(old[0]), **row}
+        else:
+            row.setdefault("data_aggiunto", _now_iso())
+        self._conn.execute(
+            "insert into subscriptions (id, user_id, nome, categoria, data_rinnovo, data_aggiunto, data) values (?, ?, ?, ?, ?, ?, ?) "
+            "on conflict(id) do update set nome = excluded.nome, categoria = excluded.categoria, "
+            "data_rinnovo = excluded.data_rinnovo, data = excluded.data",
+            (
+                row["id"],
+                user_id,
+                row.get("nome"),
+                row.get("categoria") or "Altro",
+                row.get("data_rinnovo"),
+                str(row["data_aggiunto"]),
+                json.dumps(row, default=str),
+            ),
+        )
+        return row
+
+    def upsert_subscription(self, user_id: str, row: dict) -> dict:
+        with self._lock:
+            with self._conn:
+                return self._upsert(user_id, row)
+
+    def upsert_subscriptions(self, user_id: str, rows: list[dict]) -> dict[str, list]:
+        # Un'unica transazione per tutto il batch.
+        with self._lock:
+            try:
+                self._conn.execute("begin")
+                saved = [self._upsert(user_id, r) for r in rows]
+                self._conn.execute("commit")
+            except Exception as e:
+                self._conn.execute("rollback")
+                return {"saved": [], "failed": [{"rows": rows, "error": str(e)}]}
+        return {"saved": saved, "failed": []}
+
+    def delete_subscription(self, user_id: str, sub_id: str) -> None:
+        with self._lock:
+            self._conn.execute("delete from subscriptions where id = ? and user_id = ?", (sub_id, user_id))
+
+    def get_profile(self, user_id: str) -> dict:
+        with self._lock:
+            r = self._conn.execute("select data, xp from profiles where user_id = ?", (user_id,)).fetchone()
+        if r is None:
+            return dict(DEFAULT_PROFILE)
+        return {**json.loads(r[0]), "xp": int(r[1])}
+
+    def save_profile(self, user_id: str, row: dict) -> dict:
+        data = {k: v for k, v in row.items() if k != "xp"}
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "insert into profiles (user_id, data) values (?, ?) on conflict(user_id) do update set data = excluded.data",
+                    (user_id, json.dumps(data, default=str)),
+                )
+                xp = self._conn.execute("select xp from profiles where user_id = ?", (user_id,)).fetchone()[0]
+        return {**data, "xp": int(xp)}
+
+    def increment_xp(self, user_id: str, delta: int) -> int:
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "insert into profiles (user_id, data, xp) values (?, '{}', ?) on conflict(user_id) do update set xp = xp + excluded.xp",
+                    (user_id, int(delta)),
+                )
+                return int(self._conn.execute("select xp from profiles where user_id = ?", (user_id,)).fetchone()[0])
+
+    def get_challenge(self, user_id: str) -> dict:
+        with self._lock:
+            r = self._conn.execute("select data from challenges where user_id = ?", (user_id,)).fetchone()
+        return json.loads(r[0]) if r else {}
+
+    def save_challenge(self, user_id: str, row: dict) -> dict:
+        with self._lock:
+            self._conn.execute(
+                "insert into challenges (user_id, data) values (?, ?) on conflict(user_id) do update set data = excluded.data",
+                (user_id, json.dumps(row, default=str)),
+            )
+        return dict(row)
+
+
+class SupabaseStorage(Storage):
+    # Le chiamate di supabase_client, più la cache write-through di sessione e il
+    # delta sync condiviso. Un'istanza per sessione/access token.
+    def __init__(self, access_token: str, sync: DeltaSync, page_size: int = 10):
+        self.access_token = access_token
+        self.sync = sync
+        self.page_size = page_size
+        self._cache: Optional[SubscriptionCache] = None
+        # summary e prima pagina del primo caricamento, finché manca la lista completa
+        self._cold: dict[str, Any] = {}
+
+    def _subs_cache(self, user_id: str) -> SubscriptionCache:
+        if self._cache is None or self._cache.user_id != user_id:
+            self._cache = SubscriptionCache(user_id)
+            self._cold = {}
+        return self._cache
+
+    def subscriptions_ready(self, user_id: str) -> bool:
+        return self._subs_cache(user_id).rows() is not None
+
+    def list_subscriptions(self, user_id: str) -> list[dict]:
+        token, sync, cache = self.access_token, self.sync, self._subs_cache(user_id)
+        rows = cache.rows()
+        if rows is None and cache.refreshing:
+            rows = cache.wait(supabase_client.BUNDLE_TIMEOUT)
+        if rows is None:
+            rows = cache.load(sync.sync(token, user_id))
+        elif cache.stale:
+            cache.refresh_async(lambda: sync.sync(token, user_id))
+        return rows
+
+    def page_subscriptions(self, user_id: str, offset: int, limit: int) -> list[dict]:
+        if self.subscriptions_ready(user_id):
+            return super().page_subscriptions(user_id, offset, limit)
+        first = self._cold.get("first_page")
+        if offset == 0 and first is not None and (len(first) >= limit or len(first) < self.page_size):
+            return first[:limit]
+        try:
+            return supabase_client.fetch_subscriptions_page(self.access_token, user_id, offset, limit)
+        except Exception:
+            # Query paginata fallita: si ripiega sulla lista completa.
+            return super().page_subscriptions(user_id, offset, limit)
+
+    def summary(self, user_id: str) -> dict[str, Any]:
+        if self.subscriptions_ready(user_id):
+            return super().summary(user_id)
+        if "summary" not in self._cold:
+            try:
+                self._cold["summary"] = supabase_client.fetch_subscription_summary(self.access_token)
+            except Exception:
+                # RPC assente (schema non migrato) o in errore: calcolo locale
+                # sulla lista completa, come prima della summary RPC.
+                return super().summary(user_id)
+        return self._cold["summary"]
+
+    # Scritture: una sola chiamata, poi la riga restituita viene applicata alla
+    # cache invece di riscaricare la lista. Errori e conflitti svuotano la cache.
+    def upsert_subscription(self, user_id: str, row: dict) -> dict:
+        cache = self._subs_cache(user_id)
+        self._cold = {}
+        try:
+            saved = supabase_client.upsert_subscription(self.access_token, {**row, "user_id": user_id})
+        except Exception:
+            cache.invalidate()
+            raise
+        cache.apply_upsert(saved)
+        return saved
+
+    def upsert_subscriptions(self, user_id: str, rows: list[dict]) -> dict[str, list]:
+        cache = self._subs_cache(user_id)
+        self._cold = {}
+        res = supabase_client.upsert_subscriptions(self.access_token, [{**r, "user_id": user_id} for r in rows])
+        if not cache.apply_upserts(res["saved"]) or res["failed"]:
+            cache.invalidate()
+        return res
+
+    def delete_subscription(self, user_id: str, sub_id: str) -> None:
+        cache = self._subs_cache(user_id)
+        self._cold = {}
+        try:
+            supabase_client.delete_subscription(self.access_token, sub_id, user_id)
+        except Exception:
+            cache.invalidate()
+            raise
+        cache.apply_delete([sub_id])
+
+    def get_profile(self, user_id: str) -> dict:
+        return supabase_client.fetch_or_create_profile(self.access_token, user_id)
+
+    def save_profile(self, user_id: str, row: dict) -> dict:
+        # Gli XP non passano da qui: li incrementa solo l'RPC.
+        data = {k: v for k, v in row.items() if k != "xp"}
+        data["user_id"] = user_id
+        return supabase_client.upsert_profile(self.access_token, data) or {}
+
+    def increment_xp(self, user_id: str, delta: int) -> int:
+        return supabase_client.increment_xp(self.access_token, delta)
+
+    def get_challenge(self, user_id: str) -> dict:
+        return supabase_client.fetch_challenge(self.access_token, user_id) or {}
+
+    def save_challenge(self, user_id: str, row: dict) -> dict:
+        return supabase_client.upsert_challenge(self.access_token, {**row, "user_id": user_id}) or {}
+
+    def prefetch(self, user_id: str, parts: Iterable[str]) -> dict[str, Any]:
+        # Quello che manca arriva con un'unica tornata di query parallele. Al primo
+        # caricamento senza copia locale, header e prima pagina arrivano da summary
+        # RPC e query paginata; la lista completa si scarica in parallelo, in
+        # background, e la aspetta solo chi ne ha bisogno.
+        token, sync, cache = self.access_token, self.sync, self._subs_cache(user_id)
+        parts = list(parts)
+        cold = cache.rows() is None and not cache.refreshing
+        if cold and not sync.has(user_id):
+            parts += ["summary", "first_page"]
+        elif cold:
+            parts.append("subscriptions")
+        if len(parts) < 2:
+            return {}
+        if "summary" in parts:
+            # La lista completa parte insieme al bundle, non dopo.
+            cache.refresh_async(lambda: sync.sync(token, user_id))
+        bundle = supabase_client.load_bundle(token, user_id, parts, subscriptions_loader=sync.sync, page_size=self.page_size)
+        if bundle.summary is not None and bundle.first_page is not None:
+            self._cold = {"summary": bundle.summary, "first_page": bundle.first_page}
+        if bundle.subscriptions is not None:
+            cache.load(bundle.subscriptions)
+        return {k: v for k, v in (("profile", bundle.profile), ("challenge", bundle.challenge)) if v is not None}
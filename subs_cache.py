@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, Optional
+
+# Da incrementare quando cambia la forma delle righe in cache: le copie con una
+# versione diversa vengono scartate e risincronizzate da zero.
+SYNC_VERSION = 1
+
+
+class SubscriptionCache:
+    # Copia per sessione di user_subscriptions (modalità login), aggiornata in
+    # write-through: ogni scrittura applica subito la riga restituita da Supabase,
+    # senza riscaricare la lista. Oltre `max_age` la lista viene riallineata in
+    # background; una scrittura senza riga di ritorno (conflitto, RLS, errore)
+    # svuota la cache e la lettura successiva rifà il fetch completo.
+    def __init__(self, user_id: str, max_age: float = 120):
+        self.user_id = user_id
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._rows: Optional[list[dict[str, Any]]] = None
+        self._fetched_at = 0.0
+        # Cresce a ogni mutazione locale: un refresh partito prima viene scartato.
+        self._generation = 0
+        self._refreshing = False
+        self._idle = threading.Event()
+        self._idle.set()
+
+    def rows(self) -> Optional[list[dict[str, Any]]]:
+        # La lista non viene mai modificata sul posto: chi la riceve può tenerla.
+        with self._lock:
+            return self._rows
+
+    def load(self, rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        with self._lock:
+            self._rows = list(rows)
+            self._fetched_at = time.time()
+            self._generation += 1
+            return self._rows
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._rows = None
+            self._generation += 1
+
+    @property
+    def stale(self) -> bool:
+        return time.time() - self._fetched_at > self.max_age
+
+    @property
+    def refreshing(self) -> bool:
+        return not self._idle.is_set()
+
+    def wait(self, timeout: float) -> Optional[list[dict[str, Any]]]:
+        # Aspetta il refresh in corso (se c'è) e restituisce la lista, o None.
+        self._idle.wait(timeout)
+        return self.rows()
+
+    def apply_upsert(self, row: Optional[dict[str, Any]]) -> bool:
+        if not row or row.get("id") is None:
+            self.invalidate()
+            return False
+        with self._lock:
+            if self._rows is None:
+                # Niente lista da aggiornare, ma un refresh già partito non la conosce.
+                self._generation += 1
+                return False
+            rows = list(self._rows)
+            for i, r in enumerate(rows):
+                if r.get("id") == row["id"]:
+                    rows[i] = row
+                    break
+            else:
+                # Come il fetch (data_aggiunto desc): il nuovo va in cima.
+                rows.insert(0, row)
+            self._rows = rows
+            self._generation += 1
+            return True
+
+    def apply_upserts(self, rows: Iterable[Optional[dict[str, Any]]]) -> bool:
+        ok = True
+        for row in rows:
+            ok = self.apply_upsert(row) and ok
+        return ok
+
+    def apply_delete(self, sub_ids: Iterable[Any]) -> None:
+        gone = set(sub_ids)
+        with self._lock:
+            if self._rows is None:
+                self._generation += 1
+                return
+            self._rows = [r for r in self._rows if r.get("id") not in gone]
+            self._generation += 1
+
+    def refresh_async(self, fetch: Callable[[], list[dict[str, Any]]]) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._idle.clear()
+            generation = self._generation
+        threading.Thread(target=self._refresh, args=(fetch, generation), name="subs-refresh", daemon=True).start()
+
+    def _refresh(self, fetch: Callable[[], list[dict[str, Any]]], generation: int) -> None:
+        try:
+            rows = fetch()
+            with self._lock:
+                if self._generation == generation:
+                    self._rows = list(rows)
+                    self._fetched_at = time.time()
+        except Exception:
+            # Rete giù: si continua con la copia locale e si riprova dopo `max_age`.
+            with self._lock:
+                self._fetched_at = time.time()
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._idle.set()
+
+
+def _parse_ts(value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        ts = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+
+class DeltaSync:
+    # Copia per utente condivisa dal processo (un utente che torna, anche da
+    # un'altra sessione, scarica solo le righe cambiate). Chiede le righe con
+    # `updated_at` oltre l'high-water mark, meno `overlap` secondi per le transazioni
+    # ancora in volo, e le tombstone delle cancellazioni; il merge è idempotente.
+    # Sync completo se manca la copia, se la versione non coincide, se l'high-water
+    # è più vecchio della retention delle tombstone o se il delta fallisce.
+    def __init__(
+        self,
+        fetch_all: Callable[[str, str], list[dict[str, Any]]],
+        fetch_changes: Callable[[str, str, str], dict[str, list]],
+        overlap: float = 5.0,
+        retention_days: float = 30,
+        max_users: int = 1024,
+    ):
+        self.fetch_all = fetch_all
+        self.fetch_changes = fetch_changes
+        self.overlap = timedelta(seconds=overlap)
+        self.retention = timedelta(days=retention_days)
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self.stats = {"full": 0, "delta": 0, "delta_rows": 0}
+
+    @staticmethod
+    def _order(rows: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
+        # Stesso ordine del fetch completo: data_aggiunto desc, poi id.
+        rows = sorted(rows, key=lambda r: str(r.get("id") or ""))
+        return sorted(rows, key=lambda r: str(r.get("data_aggiunto") or ""), reverse=True)
+
+    @staticmethod
+    def _high_water(stamps: Iterable[Any], current: Optional[datetime] = None) -> Optional[datetime]:
+        hw = current
+        for v in stamps:
+            ts = _parse_ts(v)
+            if ts is not None and (hw is None or ts > hw):
+                hw = ts
+        return hw
+
+    def _store(self, user_id: str, rows: list[dict[str, Any]], high_water: Optional[datetime], kind: str, n_rows: int = 0) -> None:
+        with self._lock:
+            self.stats[kind] += 1
+            self.stats["delta_rows"] += n_rows
+            self._entries[user_id] = {"version": SYNC_VERSION, "rows": rows, "high_water": high_water}
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def has(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._entries
+
+    def forget(self, user_id: str) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def full(self, access_token: str, user_id: str) -> list[dict[str, Any]]:
+        rows = list(self.fetch_all(access_token, user_id))
+        # Senza `updated_at` (schema non migrato) l'high-water resta None: ogni
+        # sync sarà completo, come prima.
+        hw = self._high_water(r.get("updated_at") for r in rows) if all(r.get("updated_at") for r in rows) else None
+        self._store(user_id, rows, hw, "full")
+        return rows
+
+    def sync(self, access_token: str, user_id: str) -> list[dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+        hw = entry and entry["high_water"]
+        if (
+            entry is None
+            or entry["version"] != SYNC_VERSION
+            or hw is None
+            or datetime.now(timezone.utc) - hw > self.retention
+        ):
+            return self.full(access_token, user_id)
+        try:
+            delta = self.fetch_changes(access_token, user_id, (hw - self.overlap).isoformat())
+        except Exception:
+            return self.full(access_token, user_id)
+
+        changed = delta.get("rows") or []
+        deleted = delta.get("deleted") or []
+        by_id = {r.get("id"): r for r in entry["rows"]}
+        for r in changed:
+            by_id[r.get("id")] = r
+        changed_ids = {r.get("id") for r in changed}
+        for t in deleted:
+            r = by_id.get(t.get("id"))
+            # Riga ricreata dopo la cancellazione: vince la più recente.
+            if t.get("id") in changed_ids and (_parse_ts(r.get("updated_at")) or hw) > (_parse_ts(t.get("deleted_at")) or hw):
+                continue
+            by_id.pop(t.get("id"), None)
+        rows = self._order(by_id.values()) if changed or deleted else entry["rows"]
+        new_hw = self._high_water([r.get("updated_at") for r in changed] + [t.get("deleted_at") for t in deleted], hw)
+        self._store(user_id, rows, new_hw, "delta", len(changed) + len(deleted))
+        return rows
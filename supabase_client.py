@@ -1,9 +1,31 @@
 from __future__ import annotations
 
-from typing import Any
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, NamedTuple, Optional
 
 import streamlit as st
-from supabase import create_client, Client
+
+from tracing import bind, traced
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+# Pool di client autenticati, uno per access token: ogni client tiene la propria
+# sessione HTTP keep-alive, quindi i rerun della stessa sessione riusano la connessione.
+POOL_MAX_CLIENTS = 64
+BATCH_CHUNK_SIZE = 200
+BUNDLE_TIMEOUT = 8.0
+TOMBSTONE_RETENTION_DAYS = 30
+# Colonne che servono a card e lista: niente note, timestamp o colonne future.
+LIST_COLUMNS = "id,nome,categoria,icona,tipo_pagamento,prezzo_mese,prezzo_anno_originale,utilizzi_mese,data_rinnovo"
+_pool: OrderedDict[str, _PooledClient] = OrderedDict()
+_pool_lock = threading.Lock()
 
 
 def supabase_enabled() -> bool:
@@ -11,75 +33,426 @@ def supabase_enabled() -> bool:
 
 
 def _base_client() -> Client:
+    # Import lazy: supabase costa ~0,4 s e serve solo a chi fa login.
+    from supabase import create_client
+
     return create_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_ANON_KEY"])
 
 
-def _authed_client(access_token: str) -> Client:
-    sb = _base_client()
+def _token_expiry(access_token: str) -> float:
+    # Legge solo il claim "exp" del JWT (nessuna verifica: serve per l'eviction).
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp else float("inf")
+    except Exception:
+        return float("inf")
+
+
+def _close_client(sb: Client) -> None:
+    try:
+        sb.postgrest.aclose()
+    except Exception:
+        pass
+
+
+class _PooledClient:
+    # Client del pool con il numero di chiamate in corso: chi lo toglie dalla
+    # mappa (scadenza, LRU, logout) lo chiude solo se nessuno lo sta usando,
+    # altrimenti lo chiude l'ultima chiamata che lo rilascia.
+    __slots__ = ("client", "expires", "refs", "evicted")
+
+    def __init__(self, client: Client, expires: float):
+        self.client = client
+        self.expires = expires
+        self.refs = 0
+        self.evicted = False
+
+
+def _evict(access_token: str) -> list[Client]:
+    # Da chiamare con _pool_lock preso; restituisce i client da chiudere.
+    entry = _pool.pop(access_token)
+    entry.evicted = True
+    return [entry.client] if entry.refs == 0 else []
+
+
+def _evict_expired(now: float) -> list[Client]:
+    expired = [tok for tok, entry in _pool.items() if entry.expires <= now]
+    return [sb for tok in expired for sb in _evict(tok)]
+
+
+def _acquire_client(access_token: str) -> _PooledClient:
+    now = time.time()
+    with _pool_lock:
+        entry = _pool.get(access_token)
+        if entry and entry.expires > now:
+            _pool.move_to_end(access_token)
+            entry.refs += 1
+            return entry
+        stale = _evict_expired(now)
+
+    sb: Optional[Client] = _base_client()
     # Important: imposta JWT per PostgREST (RLS)
     sb.postgrest.auth(access_token)
-    return sb
+
+    with _pool_lock:
+        entry = _pool.get(access_token)
+        if entry is None:
+            entry = _pool[access_token] = _PooledClient(sb, _token_expiry(access_token))
+            sb = None
+        _pool.move_to_end(access_token)
+        entry.refs += 1
+        while len(_pool) > POOL_MAX_CLIENTS:
+            stale += _evict(next(iter(_pool)))
+
+    if sb is not None:
+        # Un'altra chiamata ha creato il client per lo stesso token nel frattempo.
+        stale.append(sb)
+    for old in stale:
+        _close_client(old)
+    return entry
+
+
+def _release_ref(entry: _PooledClient) -> None:
+    with _pool_lock:
+        entry.refs -= 1
+        close = entry.evicted and entry.refs == 0
+    if close:
+        _close_client(entry.client)
 
 
+@contextmanager
+def _authed_client(access_token: str) -> Iterator[Client]:
+    entry = _acquire_client(access_token)
+    try:
+        yield entry.client
+    finally:
+        _release_ref(entry)
+
+
+def release_client(access_token: str) -> None:
+    with _pool_lock:
+        stale = _evict(access_token) if access_token in _pool else []
+    for old in stale:
+        _close_client(old)
+
+
+@traced(cat="supabase")
 def sign_up(email: str, password: str) -> dict[str, Any]:
     sb = _base_client()
     res = sb.auth.sign_up({"email": email, "password": password})
     return {"user": res.user, "session": res.session}
 
 
+@traced(cat="supabase")
 def sign_in(email: str, password: str) -> dict[str, Any]:
     sb = _base_client()
     res = sb.auth.sign_in_with_password({"email": email, "password": password})
     return {"user": res.user, "session": res.session}
 
 
+@traced(cat="supabase")
 def sign_out(access_token: str) -> None:
-    sb = _authed_client(access_token)
-    sb.auth.sign_out()
-
-
-def fetch_subscriptions(access_token: str, user_id: str) -> list[dict]:
-    sb = _authed_client(access_token)
-    res = (
-        sb.table("user_subscriptions")
-        .select("*")
-        .eq("user_id", user_id)
-        .order("data_aggiunto", desc=True)
-        .execute()
-    )
-    return res.data or []
+    with _authed_client(access_token) as sb:
+        try:
+            sb.auth.sign_out()
+        finally:
+            release_client(access_token)
+
 
+@traced(cat="supabase")
+def fetch_subscriptions(access_token: str, user_id: str, columns: str = "*") -> list[dict]:
+    with _authed_client(access_token) as sb:
+        res = (
+            sb.table("user_subscriptions")
+            .select(columns)
+            .eq("user_id", user_id)
+            .order("data_aggiunto", desc=True)
+            .order("id")
+            .execute()
+        )
+        return res.data or []
 
+
+@traced(cat="supabase")
+def fetch_subscriptions_page(
+    access_token: str,
+    user_id: str,
+    offset: int,
+    limit: int,
+    columns: str = LIST_COLUMNS,
+) -> list[dict]:
+    # Solo la pagina richiesta (header Range di PostgREST), stesso ordine del fetch completo.
+    with _authed_client(access_token) as sb:
+        res = (
+            sb.table("user_subscriptions")
+            .select(columns)
+            .eq("user_id", user_id)
+            .order("data_aggiunto", desc=True)
+            .order("id")
+            .range(offset, offset + limit - 1)
+            .execute()
+        )
+        return res.data or []
+
+
+# Totale mensile, numero di abbonamenti e peggior spreco calcolati in Postgres,
+# con le stesse regole di calculator.monthly_cost / biggest_waste (a parità vince
+# il primo nell'ordine della lista). Da creare una volta:
+#
+#   create or replace function subscription_summary() returns json
+#   language sql stable security invoker as $$
+#     with s as (
+#       select *,
+#         case
+#           when lower(coalesce(tipo_pagamento, 'mensile')) = 'annuale' and coalesce(prezzo_anno_originale, 0) > 0
+#             then prezzo_anno_originale / 12.0
+#           when lower(coalesce(tipo_pagamento, 'mensile')) = 'annuale' and coalesce(prezzo_mese, 0) <= 0
+#             then 0
+#           else coalesce(prezzo_mese, 0)
+#         end as _mensile,
+#         row_number() over (order by data_aggiunto desc, id) as _pos
+#       from user_subscriptions where user_id = auth.uid()
+#     ), w as (
+#       select *, case when coalesce(utilizzi_mese, 0) > 0 then _mensile / utilizzi_mese end as _cpu from s
+#     )
+#     select json_build_object(
+#       'monthly_total', coalesce((select sum(_mensile) from s), 0),
+#       'count', (select count(*) from s),
+#       'worst', (select to_jsonb(w) - '_mensile' - '_cpu' - '_pos' from w
+#                 order by (_cpu is null), _cpu desc, case when _cpu is null then _mensile end desc, _pos
+#                 limit 1)
+#     );
+#   $$;
+@traced(cat="supabase")
+def fetch_subscription_summary(access_token: str) -> dict[str, Any]:
+    with _authed_client(access_token) as sb:
+        res = sb.rpc("subscription_summary", {}).execute()
+        data = res.data or {}
+        return {"monthly_total": data.get("monthly_total") or 0, "count": int(data.get("count") or 0), "worst": data.get("worst")}
+
+
+# Sync incrementale: `updated_at` aggiornato da trigger e una tabella di tombstone
+# per le cancellazioni. Da creare una volta:
+#
+#   alter table user_subscriptions add column if not exists updated_at timestamptz not null default now();
+#   create index if not exists user_subscriptions_user_updated on user_subscriptions (user_id, updated_at);
+#   create or replace function touch_updated_at() returns trigger language plpgsql as $$
+#     begin new.updated_at = now(); return new; end $$;
+#   create trigger user_subscriptions_touch before insert or update on user_subscriptions
+#     for each row execute function touch_updated_at();
+#
+#   create table if not exists user_subscription_tombstones (
+#     id uuid primary key, user_id uuid not null, deleted_at timestamptz not null default now());
+#   create index if not exists user_subscription_tombstones_user on user_subscription_tombstones (user_id, deleted_at);
+#   alter table user_subscription_tombstones enable row level security;
+#   create policy "own tombstones" on user_subscription_tombstones for select using (user_id = auth.uid());
+#   create or replace function record_subscription_tombstone() returns trigger
+#   language plpgsql security definer as $$
+#     begin
+#       insert into user_subscription_tombstones (id, user_id) values (old.id, old.user_id)
+#       on conflict (id) do update set deleted_at = now();
+#       return old;
+#     end $$;
+#   create trigger user_subscriptions_tombstone after delete on user_subscriptions
+#     for each row execute function record_subscription_tombstone();
+#
+# Le tombstone più vecchie di TOMBSTONE_RETENTION_DAYS possono essere cancellate
+# da un job periodico: una copia locale più vecchia rifà il sync completo.
+@traced(cat="supabase")
+def fetch_subscription_changes(access_token: str, user_id: str, since: str) -> dict[str, list]:
+    with _authed_client(access_token) as sb:
+        rows = (
+            sb.table("user_subscriptions")
+            .select("*")
+            .eq("user_id", user_id)
+            .gt("updated_at", since)
+            .execute()
+        )
+        tombs = (
+            sb.table("user_subscription_tombstones")
+            .select("id,deleted_at")
+            .eq("user_id", user_id)
+            .gt("deleted_at", since)
+            .execute()
+        )
+        return {"rows": rows.data or [], "deleted": tombs.data or []}
+
+
+@traced(cat="supabase")
 def upsert_subscription(access_token: str, row: dict) -> dict:
-    sb = _authed_client(access_token)
-    res = sb.table("user_subscriptions").upsert(row).execute()
-    return (res.data or [{}])[0]
+    with _authed_client(access_token) as sb:
+        res = sb.table("user_subscriptions").upsert(row).execute()
+        return (res.data or [{}])[0]
 
 
+@traced(cat="supabase")
 def delete_subscription(access_token: str, sub_id: str, user_id: str) -> None:
-    sb = _authed_client(access_token)
-    sb.table("user_subscriptions").delete().eq("id", sub_id).eq("user_id", user_id).execute()
+    with _authed_client(access_token) as sb:
+        sb.table("user_subscriptions").delete().eq("id", sub_id).eq("user_id", user_id).execute()
 
 
+def _chunks(items: list, size: int) -> list[list]:
+    size = max(1, int(size))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+@traced(cat="supabase")
+def upsert_subscriptions(access_token: str, rows: list[dict], chunk_size: int = BATCH_CHUNK_SIZE) -> dict[str, list]:
+    # Una richiesta per chunk; i chunk falliti vengono riportati senza bloccare gli altri.
+    with _authed_client(access_token) as sb:
+        saved: list[dict] = []
+        failed: list[dict] = []
+        for chunk in _chunks(list(rows), chunk_size):
+            try:
+                res = sb.table("user_subscriptions").upsert(chunk).execute()
+                saved.extend(res.data or [])
+            except Exception as e:
+                failed.append({"rows": chunk, "error": str(e)})
+        return {"saved": saved, "failed": failed}
+
+
+@traced(cat="supabase")
+def delete_subscriptions(
+    access_token: str, sub_ids: list[str], user_id: str, chunk_size: int = BATCH_CHUNK_SIZE
+) -> dict[str, list]:
+    with _authed_client(access_token) as sb:
+        deleted: list[str] = []
+        failed: list[dict] = []
+        for chunk in _chunks(list(sub_ids), chunk_size):
+            try:
+                sb.table("user_subscriptions").delete().in_("id", chunk).eq("user_id", user_id).execute()
+                deleted.extend(chunk)
+            except Exception as e:
+                failed.append({"ids": chunk, "error": str(e)})
+        return {"deleted": deleted, "failed": failed}
+
+
+@traced(cat="supabase")
 def fetch_profile(access_token: str, user_id: str) -> dict:
-    sb = _authed_client(access_token)
-    res = sb.table("user_profiles").select("*").eq("user_id", user_id).maybe_single().execute()
-    return res.data or {}
+    with _authed_client(access_token) as sb:
+        res = sb.table("user_profiles").select("*").eq("user_id", user_id).maybe_single().execute()
+        return res.data or {}
 
 
+@traced(cat="supabase")
 def upsert_profile(access_token: str, row: dict) -> dict:
-    sb = _authed_client(access_token)
-    res = sb.table("user_profiles").upsert(row).execute()
-    return (res.data or [{}])[0]
+    with _authed_client(access_token) as sb:
+        res = sb.table("user_profiles").upsert(row).execute()
+        return (res.data or [{}])[0]
+
 
+# Incremento XP atomico lato Postgres: niente read-modify-write del profilo, quindi
+# due tab che premiano insieme non si sovrascrivono. Da creare una volta:
+#
+#   create or replace function increment_xp(p_delta integer) returns integer
+#   language sql security invoker as $$
+#     insert into user_profiles as p (user_id, xp) values (auth.uid(), p_delta)
+#     on conflict (user_id) do update set xp = p.xp + excluded.xp
+#     returning p.xp;
+#   $$;
+@traced(cat="supabase")
+def increment_xp(access_token: str, delta: int) -> int:
+    with _authed_client(access_token) as sb:
+        res = sb.rpc("increment_xp", {"p_delta": int(delta)}).execute()
+        return int(res.data or 0)
 
+
+@traced(cat="supabase")
 def fetch_challenge(access_token: str, user_id: str) -> dict:
-    sb = _authed_client(access_token)
-    res = sb.table("user_challenges").select("*").eq("user_id", user_id).maybe_single().execute()
-    return res.data or {}
+    with _authed_client(access_token) as sb:
+        res = sb.table("user_challenges").select("*").eq("user_id", user_id).maybe_single().execute()
+        return res.data or {}
 
 
+@traced(cat="supabase")
 def upsert_challenge(access_token: str, row: dict) -> dict:
-    sb = _authed_client(access_token)
-    res = sb.table("user_challenges").upsert(row).execute()
-    return (res.data or [{}])[0]
+    with _authed_client(access_token) as sb:
+        res = sb.table("user_challenges").upsert(row).execute()
+        return (res.data or [{}])[0]
+
+
+class UserBundle(NamedTuple):
+    subscriptions: Optional[list[dict]]
+    profile: Optional[dict]
+    challenge: Optional[dict]
+    # parte -> messaggio, per le query fallite o scadute (il valore resta None)
+    errors: dict[str, str]
+    summary: Optional[dict] = None
+    first_page: Optional[list[dict]] = None
+
+
+BUNDLE_PARTS = ("subscriptions", "profile", "challenge")
+ALL_BUNDLE_PARTS = BUNDLE_PARTS + ("summary", "first_page")
+
+
+@traced(cat="supabase")
+def fetch_or_create_profile(access_token: str, user_id: str) -> dict:
+    prof = fetch_profile(access_token, user_id)
+    if not prof:
+        prof = {"user_id": user_id, "budget_mese": 0, "xp": 0}
+        upsert_profile(access_token, prof)
+    return prof
+
+
+@traced(cat="supabase")
+def load_bundle(
+    access_token: str,
+    user_id: str,
+    parts: Iterable[str] = BUNDLE_PARTS,
+    timeout: float = BUNDLE_TIMEOUT,
+    subscriptions_loader: Optional[Callable[[str, str], list[dict]]] = None,
+    page_size: int = 10,
+) -> UserBundle:
+    # Le query del caricamento pagina partono insieme: la latenza è la massima
+    # delle tre, non la somma. Ogni parte ha `timeout` secondi da quando parte
+    # davvero; chi non risponde in tempo finisce in `errors`.
+    loaders = {
+        "subscriptions": subscriptions_loader or fetch_subscriptions,
+        "profile": fetch_or_create_profile,
+        "challenge": fetch_challenge,
+        "summary": lambda token, _uid: fetch_subscription_summary(token),
+        "first_page": lambda token, uid: fetch_subscriptions_page(token, uid, 0, page_size),
+    }
+    wanted = [p for p in ALL_BUNDLE_PARTS if p in set(parts)]
+    if not wanted:
+        return UserBundle(None, None, None, {})
+    # Client creato qui, prima dei thread: altrimenti ognuno ne aprirebbe uno suo.
+    try:
+        with _authed_client(access_token):
+            pass
+    except Exception as e:
+        return UserBundle(None, None, None, {p: str(e) for p in wanted})
+    started: dict[str, float] = {}
+
+    def run(part: str) -> Any:
+        started[part] = time.monotonic()
+        return loaders[part](access_token, user_id)
+
+    # Un executor per chiamata, un thread per parte: nessuna coda condivisa tra
+    # sessioni. Chi va in timeout finisce in background senza bloccare nessuno.
+    pool = ThreadPoolExecutor(max_workers=len(wanted), thread_name_prefix="sb-bundle")
+    try:
+        futures = {p: pool.submit(bind(run), p) for p in wanted}
+    finally:
+        pool.shutdown(wait=False)
+
+    values: dict[str, Any] = {}
+    errors: dict[str, str] = {}
+    for p, fut in futures.items():
+        wait([fut], timeout=max(0.0, started.get(p, time.monotonic()) + timeout - time.monotonic()))
+        if not fut.done():
+            errors[p] = f"timeout dopo {timeout:g}s"
+        elif fut.exception() is not None:
+            errors[p] = str(fut.exception())
+        else:
+            values[p] = fut.result()
+    return UserBundle(
+        values.get("subscriptions"),
+        values.get("profile"),
+        values.get("challenge"),
+        errors,
+        values.get("summary"),
+        values.get("first_page"),
+    )
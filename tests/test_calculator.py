@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import pytest
+
+import calculator as calc
+
+CASES = [
+    [],
+    [{"nome": "Netflix", "prezzo_mese": 12.99, "utilizzi_mese": 2}],
+    [
+        {"nome": "Netflix", "prezzo_mese": 12.99, "utilizzi_mese": 2},
+        {"nome": "DAZN", "prezzo_mese": 34.99, "utilizzi_mese": 1},
+        {"nome": "Spotify", "prezzo_mese": "10.99", "utilizzi_mese": 30},
+    ],
+    [
+        {"nome": "Palestra", "tipo_pagamento": "annuale", "prezzo_anno_originale": 299, "utilizzi_mese": 0},
+        {"nome": "Cloud", "prezzo_mese": 2.99, "utilizzi_mese": None},
+    ],
+    [
+        {"nome": "A", "prezzo_mese": 10, "utilizzi_mese": 2},
+        {"nome": "B", "prezzo_mese": 15, "utilizzi_mese": 3},
+    ],
+]
+
+
+@pytest.mark.parametrize("subs", CASES)
+def test_summary_matches_legacy_functions(subs):
+    # Il riepilogo della summary RPC (e del suo fallback locale) è lo stesso del
+    # calcolo storico sulla lista completa.
+    summary = calc.Portfolio(subs).summary()
+    assert summary["count"] == len(subs)
+    assert calc.euro(summary["monthly_total"]) == calc.euro(calc.total_monthly(subs))
+    assert summary["worst"] is calc.biggest_waste(subs)
+
+
+def test_waste_ranking_is_exact():
+    huge = [
+        {"nome": "A", "prezzo_mese": 1e307, "utilizzi_mese": 1},
+        {"nome": "B", "prezzo_mese": 2e307, "utilizzi_mese": 1},
+    ]
+    assert calc.Portfolio(huge).biggest_waste()["nome"] == "B"
+    # Costi/uso che in float coincidono: vince comunque il maggiore.
+    close = [
+        {"nome": "A", "prezzo_mese": "10000000000000000.00", "utilizzi_mese": 3},
+        {"nome": "B", "prezzo_mese": "10000000000000000.01", "utilizzi_mese": 3},
+    ]
+    assert calc.Portfolio(close).biggest_waste()["nome"] == "B"
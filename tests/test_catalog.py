@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import json
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from catalog import CatalogFetcher
+
+URL = "https://example.test/catalog.json"
+BODY = json.dumps({"version": 1, "items": [{"nome": "Netflix", "prezzo_mese": 13.99}]}).encode("utf-8")
+
+
+def _response(content: bytes, status: int = 200, etag: str = '"v1"'):
+    def json_():
+        return json.loads(content)
+
+    def raise_for_status():
+        if status >= 400:
+            raise requests.HTTPError(str(status))
+
+    return SimpleNamespace(status_code=status, content=content, headers={"ETag": etag}, json=json_, raise_for_status=raise_for_status)
+
+
+@pytest.fixture
+def local(tmp_path):
+    path = tmp_path / "local.json"
+    path.write_bytes(BODY)
+    return str(path)
+
+
+def test_same_version_persists_data_and_meta(monkeypatch, tmp_path, local):
+    monkeypatch.setattr(requests, "get", lambda url, headers, timeout: _response(BODY))
+    fetcher = CatalogFetcher(URL, cache_dir=str(tmp_path / "cache"), local_path=local, max_age=float("inf"))
+    catalog = fetcher.current()
+    fetcher._refresh()
+    assert fetcher.current() is catalog
+
+    seen = {}
+
+    def conditional(url, headers, timeout):
+        seen.update(headers)
+        return _response(b"", status=304)
+
+    monkeypatch.setattr(requests, "get", conditional)
+    cold = CatalogFetcher(URL, cache_dir=str(tmp_path / "cache"), local_path="missing.json", max_age=float("inf"))
+    assert "Netflix" in cold.current()
+    cold._refresh()
+    assert seen.get("If-None-Match") == '"v1"'
+
+
+def test_same_version_skips_full_parse(monkeypatch, tmp_path, local):
+    def unparsable():
+        raise AssertionError("body parsed for an unchanged version")
+
+    monkeypatch.setattr(requests, "get", lambda url, headers, timeout: _response(BODY))
+    fetcher = CatalogFetcher(URL, cache_dir=str(tmp_path / "cache"), local_path=local, max_age=float("inf"))
+    fetcher.current()
+    fetcher._refresh()
+
+    resp = _response(BODY, etag='"v1-gzip"')
+    resp.json = unparsable
+    monkeypatch.setattr(requests, "get", lambda url, headers, timeout: resp)
+    fetcher._refresh()
+    with open(fetcher._meta_path, encoding="utf-8") as f:
+        assert json.load(f)["etag"] == '"v1-gzip"'
+
+
+def test_refresh_without_cache_dir(monkeypatch, local):
+    monkeypatch.setattr(requests, "get", lambda url, headers, timeout: _response(BODY, etag='"v2"'))
+    fetcher = CatalogFetcher(URL, local_path=local, max_age=float("inf"))
+    fetcher.current()
+    fetcher._refresh()
+    assert fetcher._meta.get("etag") == '"v2"'
@@ -0,0 +1,9 @@
+from __future__ import annotations
+
+from cents_check import cents_mismatches
+
+
+def test_cents_match_decimal():
+    checked, mismatches = cents_mismatches()
+    assert checked > 0
+    assert mismatches == []
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import export_image
+
+
+def test_encodings_of_same_poster_render_once(monkeypatch):
+    renders = []
+    real = export_image.render_social_card
+
+    def counting(*args, **kwargs):
+        renders.append(1)
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(export_image, "render_social_card", counting)
+    cache = export_image.PosterCache()
+    payload = {"monthly_total": 0, "budget": 0}
+    png = export_image.cached_social_card(payload, size=(216, 384), stamp="01/01/2026", cache=cache, encoding="png")
+    jpeg = export_image.cached_social_card(payload, size=(216, 384), stamp="01/01/2026", cache=cache, encoding="jpeg")
+    assert png != jpeg
+    assert len(renders) == 1
+    cache.clear()
+    export_image.cached_social_card(payload, size=(216, 384), stamp="01/01/2026", cache=cache, encoding="png")
+    assert len(renders) == 2
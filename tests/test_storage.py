@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import pytest
+
+import supabase_client
+from calculator import Portfolio
+from storage import SQLiteStorage, SupabaseStorage
+from subs_cache import DeltaSync
+
+ROWS = [
+    {"id": "a", "nome": "Netflix", "prezzo_mese": 12.99, "utilizzi_mese": 2, "data_aggiunto": "2026-01-02"},
+    {"id": "b", "nome": "DAZN", "prezzo_mese": 34.99, "utilizzi_mese": 1, "data_aggiunto": "2026-01-01"},
+]
+
+
+def _fail(*args, **kwargs):
+    raise RuntimeError("function subscription_summary does not exist")
+
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setattr(supabase_client, "fetch_subscription_summary", _fail)
+    monkeypatch.setattr(supabase_client, "fetch_subscriptions_page", _fail)
+    sync = DeltaSync(lambda token, uid: [dict(r) for r in ROWS], lambda token, uid, since: {"rows": [], "deleted": []})
+    return SupabaseStorage("tok", sync)
+
+
+def test_summary_falls_back_to_full_list_when_rpc_fails(store):
+    assert not store.subscriptions_ready("u1")
+    assert store.summary("u1") == Portfolio(ROWS).summary()
+    assert store.subscriptions_ready("u1")
+
+
+def test_page_falls_back_to_full_list_when_query_fails(store):
+    assert [r["id"] for r in store.page_subscriptions("u1", 1, 10)] == ["b"]
+
+
+@pytest.fixture
+def db():
+    store = SQLiteStorage()
+    yield store
+    store.close()
+
+
+def test_sqlite_batch_rolls_back_on_failure(db):
+    db.upsert_subscription("u2", {"id": "theirs", "nome": "DAZN"})
+    res = db.upsert_subscriptions("u1", [{"id": "mine", "nome": "Netflix"}, {"id": "theirs", "nome": "Rubato"}])
+    assert res["saved"] == [] and len(res["failed"]) == 1
+    assert db.list_subscriptions("u1") == []
+    assert db.list_subscriptions("u2")[0]["nome"] == "DAZN"
+
+
+def test_sqlite_update_and_delete_check_ownership(db):
+    row = db.upsert_subscription("u1", {"nome": "Netflix", "prezzo_mese": 12.99})
+    with pytest.raises(PermissionError):
+        db.upsert_subscription("u2", {"id": row["id"], "prezzo_mese": 0})
+    db.delete_subscription("u2", row["id"])
+    assert db.list_subscriptions("u1") == [row]
+    db.delete_subscription("u1", row["id"])
+    assert db.list_subscriptions("u1") == []
+
+
+def test_sqlite_save_profile_keeps_xp(db):
+    assert db.increment_xp("u1", 15) == 15
+    saved = db.save_profile("u1", {"budget_mese": 50.0, "xp": 0})
+    assert saved == {"budget_mese": 50.0, "xp": 15}
+    assert db.get_profile("u1") == {"budget_mese": 50.0, "xp": 15}
+    assert db.award_xp("u1", ["checkin"])["xp"] > 15
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import threading
+from datetime import datetime, timedelta, timezone
+
+from subs_cache import DeltaSync, SubscriptionCache
+
+NOW = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def _ts(seconds_ago: float) -> str:
+    return (NOW - timedelta(seconds=seconds_ago)).isoformat()
+
+
+class FakeServer:
+    # user_subscriptions + tombstone, filtrati come le query di supabase_client.
+    def __init__(self, rows):
+        self.rows = {r["id"]: dict(r) for r in rows}
+        self.tombstones: list[dict] = []
+        self.full_calls = 0
+        self.since: list[str] = []
+
+    def fetch_all(self, token, uid):
+        self.full_calls += 1
+        return [dict(r) for r in self.rows.values()]
+
+    def fetch_changes(self, token, uid, since):
+        self.since.append(since)
+        cut = datetime.fromisoformat(since)
+        return {
+            "rows": [dict(r) for r in self.rows.values() if datetime.fromisoformat(r["updated_at"]) > cut],
+            "deleted": [dict(t) for t in self.tombstones if datetime.fromisoformat(t["deleted_at"]) > cut],
+        }
+
+    def delete(self, sid, seconds_ago):
+        self.rows.pop(sid)
+        self.tombstones.append({"id": sid, "deleted_at": _ts(seconds_ago)})
+
+
+def _sync(server, **kwargs):
+    return DeltaSync(server.fetch_all, server.fetch_changes, **kwargs)
+
+
+def _row(sid, added, seconds_ago):
+    return {"id": sid, "nome": sid, "data_aggiunto": added, "updated_at": _ts(seconds_ago)}
+
+
+def test_delete_then_recreate_keeps_the_new_row():
+    server = FakeServer([_row("a", "2026-01-01", 60), _row("b", "2026-01-02", 60)])
+    sync = _sync(server)
+    sync.sync("tok", "u1")
+    server.delete("a", 30)
+    server.rows["a"] = _row("a", "2026-01-03", 20)
+    rows = sync.sync("tok", "u1")
+    assert [r["id"] for r in rows] == ["a", "b"]
+    assert rows[0]["data_aggiunto"] == "2026-01-03"
+    assert server.full_calls == 1
+
+
+def test_update_then_delete_removes_the_row():
+    server = FakeServer([_row("a", "2026-01-01", 60), _row("b", "2026-01-02", 60)])
+    sync = _sync(server)
+    sync.sync("tok", "u1")
+    server.rows["a"] = _row("a", "2026-01-01", 30)
+    server.delete("a", 20)
+    assert [r["id"] for r in sync.sync("tok", "u1")] == ["b"]
+
+
+def test_row_committed_at_the_high_water_mark_is_not_missed():
+    server = FakeServer([_row("a", "2026-01-01", 10)])
+    sync = _sync(server, overlap=5)
+    sync.sync("tok", "u1")
+    # Transazione più lenta con lo stesso updated_at dell'high-water mark.
+    server.rows["b"] = _row("b", "2026-01-02", 10)
+    rows = sync.sync("tok", "u1")
+    assert [r["id"] for r in rows] == ["b", "a"]
+    assert server.since[-1] == _ts(15)
+    assert sync.stats["delta"] == 1 and server.full_calls == 1
+
+
+def test_merge_keeps_fetch_order():
+    server = FakeServer([_row("b", "2026-01-01", 60), _row("a", "2026-01-01", 60), _row("c", "2026-01-05", 60)])
+    sync = _sync(server)
+    sync.sync("tok", "u1")
+    server.rows["d"] = _row("d", "2026-01-03", 5)
+    server.rows["a"] = _row("a", "2026-01-01", 5)
+    assert [r["id"] for r in sync.sync("tok", "u1")] == ["c", "d", "a", "b"]
+
+
+def test_high_water_older_than_retention_forces_full_sync():
+    server = FakeServer([_row("a", "2026-01-01", 40 * 86400)])
+    sync = _sync(server, retention_days=30)
+    sync.sync("tok", "u1")
+    sync.sync("tok", "u1")
+    assert server.full_calls == 2
+    assert server.since == []
+    assert sync.stats["full"] == 2 and sync.stats["delta"] == 0
+
+
+def test_failed_delta_falls_back_to_full_sync():
+    server = FakeServer([_row("a", "2026-01-01", 60)])
+
+    def broken(token, uid, since):
+        raise ConnectionError("down")
+
+    sync = DeltaSync(server.fetch_all, broken)
+    sync.sync("tok", "u1")
+    assert [r["id"] for r in sync.sync("tok", "u1")] == ["a"]
+    assert server.full_calls == 2
+
+
+def test_write_through_updates_in_place_and_on_top():
+    cache = SubscriptionCache("u1")
+    cache.load([{"id": "a", "prezzo_mese": 5}, {"id": "b", "prezzo_mese": 7}])
+    assert cache.apply_upsert({"id": "b", "prezzo_mese": 9})
+    assert cache.apply_upsert({"id": "c", "prezzo_mese": 1})
+    cache.apply_delete(["a"])
+    assert cache.rows() == [{"id": "c", "prezzo_mese": 1}, {"id": "b", "prezzo_mese": 9}]
+
+
+def test_write_without_returned_row_invalidates():
+    cache = SubscriptionCache("u1")
+    cache.load([{"id": "a"}])
+    assert not cache.apply_upsert(None)
+    assert cache.rows() is None
+
+
+def test_refresh_async_and_wait():
+    cache = SubscriptionCache("u1")
+    cache.refresh_async(lambda: [{"id": "a"}])
+    assert cache.wait(5) == [{"id": "a"}]
+    assert not cache.refreshing and not cache.stale
+
+
+def test_refresh_started_before_a_local_write_is_discarded():
+    cache = SubscriptionCache("u1")
+    cache.load([{"id": "a", "prezzo_mese": 5}])
+    started, release = threading.Event(), threading.Event()
+
+    def slow_fetch():
+        started.set()
+        release.wait(5)
+        return [{"id": "a", "prezzo_mese": 5}]
+
+    cache.refresh_async(slow_fetch)
+    assert started.wait(5)
+    assert cache.apply_upsert({"id": "a", "prezzo_mese": 8})
+    release.set()
+    assert cache.wait(5) == [{"id": "a", "prezzo_mese": 8}]
+    assert not cache.refreshing
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import nullcontext
+
+import supabase_client
+
+
+def test_bundle_times_out_slow_part_only(monkeypatch):
+    release = threading.Event()
+
+    def slow_challenge(token, uid):
+        release.wait(5)
+        return {"streak_days": 1}
+
+    monkeypatch.setattr(supabase_client, "_authed_client", lambda token: nullcontext())
+    monkeypatch.setattr(supabase_client, "fetch_or_create_profile", lambda token, uid: {"xp": 10})
+    monkeypatch.setattr(supabase_client, "fetch_challenge", slow_challenge)
+    t0 = time.monotonic()
+    bundle = supabase_client.load_bundle("tok", "u1", ("profile", "challenge"), timeout=0.2)
+    release.set()
+    assert time.monotonic() - t0 < 2
+    assert bundle.profile == {"xp": 10}
+    assert bundle.challenge is None
+    assert "challenge" in bundle.errors and "profile" not in bundle.errors
+
+
+def test_bundle_parts_do_not_queue_behind_each_other(monkeypatch):
+    def slow(token, uid):
+        time.sleep(0.3)
+        return {}
+
+    monkeypatch.setattr(supabase_client, "_authed_client", lambda token: nullcontext())
+    monkeypatch.setattr(supabase_client, "fetch_subscriptions", slow)
+    monkeypatch.setattr(supabase_client, "fetch_or_create_profile", slow)
+    monkeypatch.setattr(supabase_client, "fetch_challenge", slow)
+    bundles = []
+    threads = [
+        threading.Thread(target=lambda: bundles.append(supabase_client.load_bundle("tok", "u1", timeout=0.5)))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(bundles) == 8
+    assert all(not b.errors for b in bundles)
+
+
+class FakeClient:
+    def __init__(self):
+        self.closed = False
+        self.postgrest = self
+
+    def auth(self, token):
+        pass
+
+    def aclose(self):
+        self.closed = True
+
+
+def test_pool_eviction_waits_for_clients_in_use(monkeypatch):
+    monkeypatch.setattr(supabase_client, "_base_client", FakeClient)
+    monkeypatch.setattr(supabase_client, "_pool", type(supabase_client._pool)())
+    monkeypatch.setattr(supabase_client, "POOL_MAX_CLIENTS", 1)
+    with supabase_client._authed_client("tok-a") as a:
+        with supabase_client._authed_client("tok-b") as b:
+            assert list(supabase_client._pool) == ["tok-b"]
+            assert not a.closed
+        assert not b.closed
+    assert a.closed and not b.closed
+
+
+def test_release_closes_idle_client(monkeypatch):
+    monkeypatch.setattr(supabase_client, "_base_client", FakeClient)
+    monkeypatch.setattr(supabase_client, "_pool", type(supabase_client._pool)())
+    with supabase_client._authed_client("tok-a") as a:
+        supabase_client.release_client("tok-a")
+        assert not a.closed
+    assert a.closed
+    with supabase_client._authed_client("tok-a") as again:
+        assert again is not a
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import pytest
+
+import export_image
+from text_layout import ELLIPSIS, font, truncate, wrap
+
+F = font(export_image.FONT_PATH, 36)
+
+TEXTS = [
+    "",
+    "   ",
+    "Quanto ti costa davvero ogni singolo utilizzo di ogni abbonamento?",
+    "Supercalifragilistichespiralidoso corto",
+    "Taglia un abbonamento a settimana per un mese intero",
+    "AV Wa To Ty — kerning",
+]
+
+
+def old_wrap(text: str, f, max_width: float) -> list[str]:
+    # Il vecchio _wrap di export_image: rimisura la riga intera a ogni parola.
+    lines = []
+    cur = ""
+    for w in (text or "").split():
+        test = (cur + " " + w).strip()
+        if f.getlength(test) <= max_width:
+            cur = test
+        else:
+            if cur:
+                lines.append(cur)
+            cur = w
+    if cur:
+        lines.append(cur)
+    return lines
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("max_width", [120, 300, 520, 900])
+def test_wrap_matches_old_greedy(text, max_width):
+    assert wrap(text, F, max_width) == old_wrap(text, F, max_width)
+
+
+def test_wrap_keeps_a_word_wider_than_the_line():
+    word = "Supercalifragilistichespiralidoso"
+    assert F.getlength(word) > 200
+    assert wrap(f"{word} corto", F, 200) == [word, "corto"]
+    assert wrap("", F, 200) == []
+
+
+def test_truncate_keeps_text_that_fits():
+    assert truncate("Netflix", F, 1000) == "Netflix"
+    assert truncate("", F, 10) == ""
+
+
+@pytest.mark.parametrize("max_width", [80, 150, 333, 500])
+def test_truncate_returns_longest_fitting_prefix(max_width):
+    text = "Pacchetto sport premium con tutti i canali"
+    out = truncate(text, F, max_width)
+    assert out.endswith(ELLIPSIS)
+    assert F.getlength(out) <= max_width
+    n = len(out) - len(ELLIPSIS)
+    assert text.startswith(out[:n])
+    # Un carattere in più non ci starebbe più.
+    longer = [
+        k for k in range(n + 1, len(text))
+        if len(text[:k].rstrip()) > n and F.getlength(text[:k].rstrip() + ELLIPSIS) <= max_width
+    ]
+    assert longer == []
+
+
+@pytest.mark.parametrize("name", ["Netflix", "Abbonamento con un nome davvero lunghissimo " * 3])
+@pytest.mark.parametrize("max_width", [250, 400, 900])
+def test_fit_value_keeps_the_amount(name, max_width):
+    out = export_image._fit_value(f"{name} • €17,50", F, max_width)
+    assert out.endswith(" • €17,50")
+    assert F.getlength(out) <= max_width
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Union
+
+from PIL import ImageFont
+
+Font = Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]
+
+ELLIPSIS = "…"
+
+
+@lru_cache(maxsize=64)
+def font(path: str, size: int) -> Font:
+    # Un'istanza per (file, dimensione) per tutto il processo.
+    try:
+        return ImageFont.truetype(path, size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=8192)
+def text_width(f: Font, text: str) -> float:
+    return f.getlength(text)
+
+
+def wrap(text: str, f: Font, max_width: float) -> list[str]:
+    # Ogni parola viene misurata una volta sola (cache) e la riga cresce sommando
+    # le larghezze: lineare nel numero di parole.
+    space = text_width(f, " ")
+    lines: list[str] = []
+    cur: list[str] = []
+    cur_w = 0.0
+    for w in (text or "").split():
+        ww = text_width(f, w)
+        if not cur:
+            cur, cur_w = [w], ww
+        elif cur_w + space + ww <= max_width:
+            cur.append(w)
+            cur_w += space + ww
+        else:
+            lines.append(" ".join(cur))
+            cur, cur_w = [w], ww
+    if cur:
+        lines.append(" ".join(cur))
+    return lines
+
+
+def truncate(text: str, f: Font, max_width: float, ellipsis: str = ELLIPSIS) -> str:
+    text = text or ""
+    if f.getlength(text) <= max_width:
+        return text
+    # Ricerca binaria sul prefisso più lungo che ci sta insieme all'ellissi.
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if f.getlength(text[:mid].rstrip() + ellipsis) <= max_width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip() + ellipsis
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar, copy_context
+from typing import Any, Callable, ContextManager, Optional, TypeVar
+
+# Span di durata raccolti per rerun. Senza una Trace attiva (default) span() e
+# @traced costano una lettura di ContextVar e niente altro.
+#
+# Export: JSON lines nel formato "trace event" di Chrome/Perfetto, un evento
+# completo ("ph": "X") per riga, tempi in microsecondi. Per aprirlo:
+#   jq -s '{traceEvents: .}' trace.jsonl > trace.json   (poi ui.perfetto.dev)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+_current: ContextVar[Optional[Trace]] = ContextVar("streamsaver_trace", default=None)
+_NOOP = nullcontext()
+_export_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, label: str = "rerun", session: str = ""):
+        self.label = label
+        self.session = session
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.closed = False
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans: list[dict[str, Any]] = []
+
+    def add(self, name: str, cat: str, start: float, end: float, args: Optional[dict[str, Any]] = None) -> None:
+        span = {"name": name, "cat": cat, "start": start - self._t0, "dur": end - start, "tid": threading.get_ident()}
+        if args:
+            span["args"] = args
+        with self._lock:
+            self.spans.append(span)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.duration = time.perf_counter() - self._t0
+            self.closed = True
+
+    def summary(self) -> list[dict[str, Any]]:
+        # Per nome: chiamate, tempo totale e massimo, dal più costoso.
+        agg: dict[str, dict[str, Any]] = {}
+        with self._lock:
+            spans = list(self.spans)
+        for s in spans:
+            a = agg.setdefault(s["name"], {"span": s["name"], "cat": s["cat"], "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0})
+            ms = s["dur"] * 1e3
+            a["calls"] += 1
+            a["total_ms"] += ms
+            a["max_ms"] = max(a["max_ms"], ms)
+            a["errors"] += "error" in s.get("args", {})
+        return sorted(agg.values(), key=lambda a: a["total_ms"], reverse=True)
+
+    def events(self) -> list[dict[str, Any]]:
+        pid = os.getpid()
+        base = self.started_at * 1e6
+        meta = {"session": self.session, "trace": self.label}
+        with self._lock:
+            spans = list(self.spans)
+        events = [{
+            "name": self.label,
+            "cat": "rerun",
+            "ph": "X",
+            "ts": round(base),
+            "dur": round(self.duration * 1e6),
+            "pid": pid,
+            "tid": threading.get_ident(),
+            "args": {**meta, "spans": len(spans)},
+        }]
+        for s in spans:
+            events.append({
+                "name": s["name"],
+                "cat": s["cat"],
+                "ph": "X",
+                "ts": round(base + s["start"] * 1e6),
+                "dur": round(s["dur"] * 1e6),
+                "pid": pid,
+                "tid": s["tid"],
+                "args": {**meta, **s.get("args", {})},
+            })
+        return events
+
+    def jsonl(self) -> str:
+        return "".join(json.dumps(e, default=str) + "\n" for e in self.events())
+
+
+class _Span:
+    __slots__ = ("trace", "name", "cat", "args", "start")
+
+    def __init__(self, trace: Trace, name: str, cat: str, args: dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self) -> _Span:
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        end = time.perf_counter()
+        # Solo gli errori veri: i rerun di Streamlit passano di qui come BaseException.
+        if isinstance(exc, Exception):
+            self.args["error"] = f"{type(exc).__name__}: {exc}"
+        self.trace.add(self.name, self.cat, self.start, end, self.args)
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+def activate(trace: Optional[Trace]) -> None:
+    _current.set(trace)
+
+
+def span(name: str, cat: str = "app", **args: Any) -> ContextManager[Any]:
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, cat, args)
+
+
+def traced(name: Optional[str] = None, cat: str = "app") -> Callable[[F], F]:
+    def deco(fn: F) -> F:
+        label = name or f"{fn.__module__}.{fn.__name__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return fn(*args, **kwargs)
+            with _Span(trace, label, cat, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return deco
+
+
+def bind(fn: F) -> F:
+    # Per i thread pool: la funzione gira nel contesto (e nella Trace) di chi la sottomette.
+    if _current.get() is None:
+        return fn
+    return functools.partial(copy_context().run, fn)  # type: ignore[return-value]
+
+
+def export_jsonl(trace: Trace, path: str) -> None:
+    # Append: più sessioni dello stesso processo scrivono sullo stesso file.
+    data = trace.jsonl()
+    with _export_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(data)